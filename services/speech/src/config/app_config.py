@@ -35,6 +35,7 @@ class Speech2TxtConfig(Config):
 
     #For asr
     model_name = speech2txt_cfg['model_name']
+    model_revision = speech2txt_cfg['model_revision']
     model_cache= speech2txt_cfg['model_cache']
     post_processing_task = speech2txt_cfg['post_processing_task']
     post_processing_model_cache = speech2txt_cfg['post_processing_model_cache']
@@ -43,6 +44,47 @@ class Speech2TxtConfig(Config):
     return_tensors = speech2txt_cfg['return_tensors']
     padding = speech2txt_cfg['padding']
     max_len_post_processing = speech2txt_cfg['max_len_post_processing']
+    correction_batch_size = speech2txt_cfg['correction_batch_size']
+    correction_batch_wait_seconds = speech2txt_cfg['correction_batch_wait_seconds']
+    correction_length_ratio = speech2txt_cfg['correction_length_ratio']
+    correction_length_margin = speech2txt_cfg['correction_length_margin']
+    correction_confidence_threshold = speech2txt_cfg['correction_confidence_threshold']
+    correction_min_words = speech2txt_cfg['correction_min_words']
+    correction_cache_entries = speech2txt_cfg['correction_cache_entries']
+    correction_cache_bytes = speech2txt_cfg['correction_cache_bytes']
+    correction_cache_path = speech2txt_cfg['correction_cache_path']
+    correction_cache_disk_entries = speech2txt_cfg['correction_cache_disk_entries']
+    correction_engine = speech2txt_cfg['correction_engine']
+
+    #For symspell correction
+    symspell_dictionary_path = speech2txt_cfg['symspell_dictionary_path']
+    symspell_bigram_path = speech2txt_cfg['symspell_bigram_path']
+    symspell_index_dir = speech2txt_cfg['symspell_index_dir']
+    symspell_max_edit_distance = speech2txt_cfg['symspell_max_edit_distance']
+    symspell_prefix_length = speech2txt_cfg['symspell_prefix_length']
+    batch_size = speech2txt_cfg['batch_size']
+    batch_wait_seconds = speech2txt_cfg['batch_wait_seconds']
+    asr_workers = speech2txt_cfg['asr_workers']
+    vad_workers = speech2txt_cfg['vad_workers']
+    chunk_length_seconds = speech2txt_cfg['chunk_length_seconds']
+    stride_left_seconds = speech2txt_cfg['stride_left_seconds']
+    stride_right_seconds = speech2txt_cfg['stride_right_seconds']
+
+    #For ctc decoding
+    ctc_decoder = speech2txt_cfg['ctc_decoder']
+    beam_width = speech2txt_cfg['beam_width']
+    beam_blank_threshold = speech2txt_cfg['beam_blank_threshold']
+    beam_token_min_logp = speech2txt_cfg['beam_token_min_logp']
+    lm_path = speech2txt_cfg['lm_path']
+    lm_alpha = speech2txt_cfg['lm_alpha']
+    lm_beta = speech2txt_cfg['lm_beta']
+
+    #For onnx export
+    onnx_export = speech2txt_cfg['onnx_export']
+    onnx_opset = speech2txt_cfg['onnx_opset']
+    onnx_quantize = speech2txt_cfg['onnx_quantize']
+    onnx_report_audio = speech2txt_cfg['onnx_report_audio']
+    onnx_report_runs = speech2txt_cfg['onnx_report_runs']
 
     #For recording
     vad_mode = speech2txt_cfg['vad_mode']
@@ -50,8 +92,25 @@ class Speech2TxtConfig(Config):
     rate = speech2txt_cfg['rate']
     frame_duration = speech2txt_cfg['frame_duration']
     channels = speech2txt_cfg['channels']
+    segment_buffer_seconds = speech2txt_cfg['segment_buffer_seconds']
+    vad_file_mode = speech2txt_cfg['vad_file_mode']
+    vad_energy_threshold_db = speech2txt_cfg['vad_energy_threshold_db']
+    vad_hangover_frames = speech2txt_cfg['vad_hangover_frames']
+    vad_padding_frames = speech2txt_cfg['vad_padding_frames']
     
 
+class OnnxRuntimeConfig(Config):
+    config = Config.load_config()
+    onnx_runtime_cfg = config['onnx_runtime']
+
+    providers = onnx_runtime_cfg['providers']
+    intra_op_num_threads = onnx_runtime_cfg['intra_op_num_threads']
+    inter_op_num_threads = onnx_runtime_cfg['inter_op_num_threads']
+    graph_optimization_level = onnx_runtime_cfg['graph_optimization_level']
+    optimized_model_dir = onnx_runtime_cfg['optimized_model_dir']
+    use_io_binding = onnx_runtime_cfg['use_io_binding']
+
+
 class EmotionAnalysisConfig(Config):
     config = Config.load_config()
     emotion_analysis_cfg = config['emotion_analysis']
@@ -62,6 +121,11 @@ class EmotionAnalysisConfig(Config):
     truncation = emotion_analysis_cfg['truncation']
     return_tensors = emotion_analysis_cfg['return_tensors']
     max_length = emotion_analysis_cfg['max_length']
+    micro_batching = emotion_analysis_cfg['micro_batching']
+    batch_size = emotion_analysis_cfg['batch_size']
+    batch_wait_seconds = emotion_analysis_cfg['batch_wait_seconds']
+    long_text_mode = emotion_analysis_cfg['long_text_mode']
+    window_stride = emotion_analysis_cfg['window_stride']
 
 
 class LLMConfig(Config):
@@ -73,6 +137,24 @@ class LLMConfig(Config):
     max_new_tokens = llm_cfg['max_new_tokens']
     temperature = llm_cfg['temperature']
     repetition_penalty = llm_cfg['repetition_penalty']
+    torch_dtype = llm_cfg['torch_dtype']
+    quantize_int8 = llm_cfg['quantize_int8']
+    stop_strings = llm_cfg['stop_strings']
+    max_sentences = llm_cfg['max_sentences']
+    stop_on_newline = llm_cfg['stop_on_newline']
+    draft_model_path = llm_cfg['draft_model_path']
+    num_assistant_tokens = llm_cfg['num_assistant_tokens']
+    continuous_batching = llm_cfg['continuous_batching']
+    max_batch_size = llm_cfg['max_batch_size']
+    prefix_cache = llm_cfg['prefix_cache']
+    response_cache = llm_cfg['response_cache']
+    response_cache_entries = llm_cfg['response_cache_entries']
+    response_cache_bytes = llm_cfg['response_cache_bytes']
+    response_cache_ttl_seconds = llm_cfg['response_cache_ttl_seconds']
+    response_cache_redis = llm_cfg['response_cache_redis']
+    response_cache_redis_ttl_seconds = llm_cfg['response_cache_redis_ttl_seconds']
+    response_cache_max_value_bytes = llm_cfg['response_cache_max_value_bytes']
+    prefix_cache_max_mb = llm_cfg['prefix_cache_max_mb']
 
 
 class Txt2SpeechConfig(Config):
@@ -84,6 +166,7 @@ class Txt2SpeechConfig(Config):
     model_config = txt2speech_cfg['model_config']
     output_file_path = txt2speech_cfg['output_file_path']
     language = txt2speech_cfg['language']
+    conditioning_cache_dir = txt2speech_cfg['conditioning_cache_dir']
  
     #Config for tts_ref
     ref_audio_neutral = tts_ref_cfg['ref_audio_neutral']
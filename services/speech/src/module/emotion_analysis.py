@@ -1,19 +1,23 @@
 import logging
 import time
-import torch
 import numpy as np
-import onnxruntime as ort
 
-from transformers import pipeline, AutoTokenizer
+from transformers import AutoTokenizer
 
 from src.utils.common import *
+from src.utils.onnx_session import OnnxSession
+from src.utils.micro_batcher import MicroBatcher
 from src.config.app_config import EmotionAnalysisConfig as ec
 
 
+def softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    probabilities = np.exp(logits)
+    return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+
 class EmotionAnalysis:
     def __init__(self):
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
         self.model_name = ec.model_name
         self.model_cache = ec.model_cache
         self.padding = ec.padding
@@ -25,16 +29,36 @@ class EmotionAnalysis:
         onnx_file = find_files(directory_path=ec.model_cache, type_file='onnx')
         if onnx_file:
             self.model_type = 'onnx'
-            self.model = ort.InferenceSession(onnx_file[0], providers=['CUDAExecutionProvider'])
+            self.model = OnnxSession(onnx_file[0])
             logging.info('Loading ONNX model for the first time.')
         else:
+            # Only the Hugging Face fallback needs torch; the ONNX path stays torch-free.
+            import torch
+            from transformers import pipeline
+
             self.model_type = 'hf'
+            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
             self.model = pipeline(self.model_name, model=self.model_cache, device=self.device)
+            self.class_labels = [self.model.model.config.id2label[i] for i in range(len(self.model.model.config.id2label))]
             logging.info('Loading pretrained Hugging Face model for the first time.')
             
         logging.info('Initialized pretrained model.')
 
         self.processor = AutoTokenizer.from_pretrained(self.model_cache)
+
+        self.long_text_mode = ec.long_text_mode
+        self.window_stride = ec.window_stride
+        self.window_tokens = self.max_length - self.processor.num_special_tokens_to_add(pair=False)
+        if self.window_stride >= self.window_tokens:
+            raise ValueError('window_stride must be smaller than the number of tokens per window')
+
+        self.batch_size = ec.batch_size
+        self.batcher = None
+        if ec.micro_batching:
+            self.batcher = MicroBatcher(self.run_batch,
+                                        max_batch_size=ec.batch_size,
+                                        max_wait_seconds=ec.batch_wait_seconds,
+                                        name='emotion-batcher')
         logging.info('Initialized emotion analysis module ...')
     
 
@@ -45,38 +69,106 @@ class EmotionAnalysis:
         return result
     
 
-    def run(self, input_text):
+    def split_windows(self, token_ids):
+        """Splits token ids into windows of window_tokens that overlap by window_stride tokens."""
+        if len(token_ids) <= self.window_tokens:
+            return [token_ids]
+
+        step = self.window_tokens - self.window_stride
+        starts = list(range(0, len(token_ids) - self.window_tokens + 1, step))
+        if starts[-1] + self.window_tokens < len(token_ids):
+            starts.append(len(token_ids) - self.window_tokens)
+        return [token_ids[start:start + self.window_tokens] for start in starts]
+
+
+    def window_logits(self, windows):
+        """Scores all windows in one padded forward pass."""
+        encoded = self.processor.pad(
+            {'input_ids': [self.processor.build_inputs_with_special_tokens(window) for window in windows]},
+            padding=True,
+            return_tensors='np')
+        input_ids, attention_mask = encoded['input_ids'], encoded['attention_mask']
+
         if self.model_type == 'hf':
-            start_time = time.time()
-            result = self.model(input_text)[0]['label']
-            end_time = time.time()
+            import torch
+
+            with torch.no_grad():
+                return self.model.model(
+                    input_ids=torch.from_numpy(input_ids).to(self.model.device),
+                    attention_mask=torch.from_numpy(attention_mask).to(self.model.device)).logits.cpu().numpy()
+
+        input_names = self.model.input_names
+        onnx_inputs = {input_names[0]: input_ids, input_names[1]: attention_mask}
+        output_shapes = {self.model.output_names[0]: (len(windows), len(self.class_labels))}
+        return self.model.run(onnx_inputs, output_shapes=output_shapes)[0]
+
+
+    def classify_long_texts(self, input_texts):
+        """Classifies texts of any length from overlapping windows.
+
+        Each text is tokenized once and split into windows; the windows of all
+        texts are scored together and their probabilities are averaged per text,
+        weighted by window length, so cost grows linearly with transcript length.
+        """
+        token_ids = self.processor(input_texts, add_special_tokens=False, truncation=False)['input_ids']
+        windows, owners = [], []
+        for text_index, ids in enumerate(token_ids):
+            for window in self.split_windows(ids):
+                windows.append(window)
+                owners.append(text_index)
+
+        probabilities = softmax(self.window_logits(windows))
+
+        owners = np.array(owners)
+        weights = np.array([max(len(window), 1) for window in windows], dtype=np.float32)
+        text_probabilities = np.zeros((len(input_texts), probabilities.shape[1]), dtype=np.float32)
+        np.add.at(text_probabilities, owners, probabilities * weights[:, None])
+        text_probabilities /= np.bincount(owners, weights=weights, minlength=len(input_texts))[:, None]
+
+        logging.info(f'Scored {len(windows)} windows for {len(input_texts)} texts')
+        return [self.class_labels[index] for index in np.argmax(text_probabilities, axis=1)]
+
+
+    def run_batch(self, input_texts):
+        """Classifies many texts with padded batched inference and returns one emotion per text."""
+        start_time = time.time()
+
+        if self.long_text_mode:
+            results = self.classify_long_texts(input_texts)
+
+        elif self.model_type == 'hf':
+            outputs = self.model(input_texts, batch_size=self.batch_size,
+                                 truncation=self.truncation, max_length=self.max_length)
+            results = [output['label'] for output in outputs]
 
         elif self.model_type == 'onnx':
-            inputs = self.processor(
-                input_text,
-                return_tensors=self.return_tensors,  
-                padding=self.padding,
-                truncation=self.truncation,
-                max_length=self.max_length
-                )
-            
-            input_names = [input.name for input in self.model.get_inputs()]
-            output_names = [output.name for output in self.model.get_outputs()]
+            results = []
+            for start in range(0, len(input_texts), self.batch_size):
+                inputs = self.processor(
+                    input_texts[start:start + self.batch_size],
+                    return_tensors=self.return_tensors,  
+                    padding=self.padding,
+                    truncation=self.truncation,
+                    max_length=self.max_length
+                    )
 
-            onnx_inputs = {input_names[0]: inputs["input_ids"], input_names[1]: inputs["attention_mask"]}
+                input_names = self.model.input_names
+                onnx_inputs = {input_names[0]: inputs["input_ids"], input_names[1]: inputs["attention_mask"]}
+                output_shapes = {self.model.output_names[0]: (inputs["input_ids"].shape[0], len(self.class_labels))}
 
-            start_time = time.time()
+                logits = self.model.run(onnx_inputs, output_shapes=output_shapes)[0]
+                probabilities = softmax(logits)
+                predicted_class_indices = np.argmax(probabilities, axis=1)
+                results.extend(self.class_labels[index] for index in predicted_class_indices)
 
-            outputs = self.model.run(output_names, onnx_inputs)
-            logits = outputs[0]
-            probabilities = torch.nn.functional.softmax(torch.tensor(logits), dim=1).numpy()
-            predicted_class_index = np.argmax(probabilities, axis=1)[0]
-            result = self.class_labels[predicted_class_index]
-            
-            end_time = time.time()
+        end_time = time.time()
+        logging.info(f'Finish inference module emotion analysis for {len(input_texts)} texts in {end_time-start_time}')
+
+        return [self.post_processing_result(result=result) for result in results]
 
-        final_result = self.post_processing_result(result=result)
-        logging.info(f'Finish inference module emotion analysis in {end_time-start_time}')
 
-        return final_result
-    
\ No newline at end of file
+    def run(self, input_text):
+        """Classifies one text, sharing a batch with concurrent callers when micro-batching is on."""
+        if self.batcher is not None:
+            return self.batcher.submit(input_text)
+        return self.run_batch([input_text])[0]
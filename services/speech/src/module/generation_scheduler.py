@@ -0,0 +1,213 @@
+import time
+import torch
+import logging
+import threading
+
+from queue import Queue, Empty
+from concurrent.futures import Future
+
+from transformers import DynamicCache, RepetitionPenaltyLogitsProcessor
+
+
+def left_pad(tensor, length, dim):
+    """Pads tensor with zeros on the left of dim up to length."""
+    missing = length - tensor.shape[dim]
+    if missing == 0:
+        return tensor
+    padding = [0, 0] * (tensor.dim() - 1 - dim) + [missing, 0]
+    return torch.nn.functional.pad(tensor, padding)
+
+
+class Sequence:
+    """One request in the running batch."""
+    def __init__(self, input_ids, past_key_values, max_new_tokens, stopping_criteria):
+        self.input_ids = input_ids
+        self.past_key_values = past_key_values
+        self.max_new_tokens = max_new_tokens
+        self.stopping_criteria = stopping_criteria
+        self.token_ids = input_ids[0].tolist()
+        self.new_tokens = 0
+        self.future = Future()
+        self.start_time = time.time()
+
+
+class GenerationScheduler:
+    """Continuous batching for greedy decoding with a causal LM.
+
+    A background thread keeps one running batch and decodes one token for all
+    of its sequences per forward pass. New requests are prefilled on their own
+    and join the batch at the next token boundary; finished sequences leave it
+    right away. The batch KV cache is left-padded to the longest sequence, and
+    the attention mask and per-row position ids hide the padding, so every
+    sequence only ever attends to its own keys and values.
+    """
+    def __init__(self, model, max_batch_size, repetition_penalty, name='generation-scheduler'):
+        self.model = model
+        self.device = model.device
+        self.max_batch_size = max_batch_size
+        self.repetition_penalty = None
+        if repetition_penalty != 1.0:
+            self.repetition_penalty = RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty)
+
+        eos_token_id = model.generation_config.eos_token_id
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+
+        self.queue = Queue()
+        self.reset()
+
+        self.generated_tokens = 0
+        self.busy_seconds = 0.0
+
+        self.thread = threading.Thread(target=self.loop, name=name, daemon=True)
+        self.thread.start()
+
+
+    def reset(self):
+        self.sequences = []
+        # Legacy per-layer (key, value) tuples shaped [batch, heads, length, head_dim].
+        self.cache = None
+        self.attention_mask = None
+
+
+    def submit(self, input_ids, max_new_tokens, past_key_values=None, stopping_criteria=None):
+        """Blocks until the request is done and returns its prompt and generated token ids.
+
+        past_key_values may hold an already prefilled prefix of input_ids, and
+        stopping_criteria may end the sequence early through its is_done().
+        """
+        sequence = Sequence(input_ids, past_key_values, max_new_tokens, stopping_criteria)
+        self.queue.put(sequence)
+        return sequence.future.result()
+
+
+    def select_tokens(self, sequences, logits):
+        """Greedy next token for every row, after the repetition penalty over its own history."""
+        if self.repetition_penalty is not None:
+            logits = torch.cat([
+                self.repetition_penalty(torch.tensor([sequence.token_ids], device=self.device), logits[i:i + 1])
+                for i, sequence in enumerate(sequences)])
+        return logits.argmax(dim=-1).tolist()
+
+
+    def append_token(self, sequence, token_id):
+        """Adds the token and returns True once the sequence is finished."""
+        sequence.token_ids.append(token_id)
+        sequence.new_tokens += 1
+        if token_id in self.eos_token_ids or sequence.new_tokens >= sequence.max_new_tokens:
+            return True
+        return sequence.stopping_criteria is not None and sequence.stopping_criteria.is_done(0, sequence.token_ids)
+
+
+    def finish(self, sequence):
+        self.generated_tokens += sequence.new_tokens
+        logging.info(f'Generated {sequence.new_tokens} tokens in {time.time() - sequence.start_time}s, '
+                     f'scheduler throughput {self.generated_tokens / max(self.busy_seconds, 1e-9):.1f} tokens/s')
+        sequence.future.set_result(sequence.token_ids)
+
+
+    def prefill(self, sequence):
+        past_key_values = sequence.past_key_values if sequence.past_key_values is not None else DynamicCache()
+        cached_length = past_key_values.get_seq_length()
+
+        with torch.no_grad():
+            output = self.model(input_ids=sequence.input_ids[:, cached_length:],
+                                past_key_values=past_key_values,
+                                use_cache=True)
+
+        token_id = self.select_tokens([sequence], output.logits[:, -1])[0]
+        if self.append_token(sequence, token_id):
+            self.finish(sequence)
+        else:
+            self.join(sequence, output.past_key_values.to_legacy_cache())
+
+
+    def join(self, sequence, cache):
+        mask = torch.ones(1, cache[0][0].shape[2], dtype=torch.long, device=self.device)
+        self.sequences.append(sequence)
+        if self.cache is None:
+            self.cache, self.attention_mask = cache, mask
+            return
+
+        length = max(self.attention_mask.shape[1], mask.shape[1])
+        self.cache = [
+            (torch.cat([left_pad(key, length, 2), left_pad(new_key, length, 2)]),
+             torch.cat([left_pad(value, length, 2), left_pad(new_value, length, 2)]))
+            for (key, value), (new_key, new_value) in zip(self.cache, cache)]
+        self.attention_mask = torch.cat([left_pad(self.attention_mask, length, 1), left_pad(mask, length, 1)])
+
+
+    def evict(self, finished):
+        """Drops finished rows and the left padding no remaining row needs."""
+        keep = [i for i in range(len(self.sequences)) if i not in finished]
+        if not keep:
+            self.reset()
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        mask = self.attention_mask.index_select(0, index)
+        start = int(torch.nonzero(mask.sum(dim=0))[0])
+
+        self.attention_mask = mask[:, start:]
+        self.cache = [(key.index_select(0, index)[:, :, start:], value.index_select(0, index)[:, :, start:])
+                      for key, value in self.cache]
+        self.sequences = [self.sequences[i] for i in keep]
+
+
+    def step(self):
+        """Decodes one token for every sequence in the running batch."""
+        input_ids = torch.tensor([[sequence.token_ids[-1]] for sequence in self.sequences], device=self.device)
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True)
+        attention_mask = torch.cat([self.attention_mask, torch.ones_like(position_ids)], dim=1)
+
+        with torch.no_grad():
+            output = self.model(input_ids=input_ids,
+                                attention_mask=attention_mask,
+                                position_ids=position_ids,
+                                past_key_values=DynamicCache.from_legacy_cache(self.cache),
+                                use_cache=True)
+
+        self.cache = output.past_key_values.to_legacy_cache()
+        self.attention_mask = attention_mask
+
+        finished = set()
+        for i, token_id in enumerate(self.select_tokens(self.sequences, output.logits[:, -1])):
+            if self.append_token(self.sequences[i], token_id):
+                self.finish(self.sequences[i])
+                finished.add(i)
+
+        if finished:
+            self.evict(finished)
+
+
+    def admit(self):
+        """Prefills waiting requests into free batch slots, blocking only while the batch is empty."""
+        while len(self.sequences) < self.max_batch_size:
+            try:
+                sequence = self.queue.get(block=not self.sequences)
+            except Empty:
+                return
+
+            start_time = time.time()
+            try:
+                self.prefill(sequence)
+            except Exception as e:
+                logging.error(f'Prefill failed: {e}')
+                sequence.future.set_exception(e)
+            self.busy_seconds += time.time() - start_time
+
+
+    def loop(self):
+        while True:
+            self.admit()
+            if not self.sequences:
+                continue
+
+            start_time = time.time()
+            try:
+                self.step()
+            except Exception as e:
+                logging.error(f'Decoding step failed for {len(self.sequences)} sequences: {e}')
+                for sequence in self.sequences:
+                    sequence.future.set_exception(e)
+                self.reset()
+            self.busy_seconds += time.time() - start_time
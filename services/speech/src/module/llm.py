@@ -1,10 +1,141 @@
+import os
 import torch
 import logging
+import hashlib
+import copy
 import re
 import time
+import threading
 
-from transformers import LlamaForCausalLM, PreTrainedTokenizerFast
-from src.config.app_config import LLMConfig as lc
+from transformers import (AutoModelForCausalLM, DynamicCache, LlamaForCausalLM, PreTrainedTokenizerFast, StoppingCriteria,
+                          StoppingCriteriaList, TextIteratorStreamer)
+from src.utils.common import log_resource_usage
+from src.utils.cache import LRUCache, RedisCache, TieredCache, normalize_text
+from src.module.generation_scheduler import GenerationScheduler
+from src.config.app_config import Config, LLMConfig as lc
+
+
+# How each emotion label is phrased in the instruction prompt.
+EMOTION_PROMPT_WORDS = {
+    'sad': 'sad',
+    'joy': 'happy',
+    'fear': 'fear',
+    'anger': 'angry',
+    'surprise': 'surprised',
+    'neutral': 'neutral',
+}
+
+
+TORCH_DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+}
+
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+SENTENCE_END = re.compile(r'[.!?]\s')
+
+
+def split_sentences(text):
+    """Splits text into the sentences that are known to be complete and the unfinished rest.
+
+    A sentence only counts as complete once whitespace follows its final
+    punctuation, so "3." in "3.5" is never cut.
+    """
+    parts = SENTENCE_BOUNDARY.split(text)
+    complete = [part.strip() for part in parts[:-1] if part.strip()]
+    return complete, parts[-1]
+
+
+def final_sentence(rest, has_sentences):
+    """The unfinished last piece of an answer if it is kept, else ''.
+
+    It is kept when it ends with sentence punctuation or when it is the
+    whole answer.
+    """
+    rest = rest.strip()
+    return rest if rest and (not has_sentences or rest[-1] in '.!?') else ''
+
+
+def trim_to_sentences(text, max_sentences=0):
+    """Drops the unfinished tail of an answer and keeps at most max_sentences sentences
+    (0 keeps all), the same way stream() does while it yields.
+    """
+    complete, rest = split_sentences(text)
+    sentences = complete + [final_sentence(rest, bool(complete))]
+    if max_sentences:
+        sentences = sentences[:max_sentences]
+    return ' '.join(sentences).strip()
+
+
+def cut_at_stop_strings(text, stop_strings):
+    for stop_string in stop_strings:
+        text = text.split(stop_string)[0]
+    return text
+
+
+class ResponseStoppingCriteria(StoppingCriteria):
+    """Ends generation as soon as the kept answer is complete.
+
+    A row stops on any of stop_strings, on a newline once it has produced
+    some text, or after max_sentences sentences (0 disables the budget).
+    Each check decodes the tokens added since the previous check plus
+    TAIL_TOKENS of context and scans only the new text, so the cost per step
+    does not grow with the response. Several tokens may arrive per check,
+    e.g. the accepted draft tokens of assisted decoding.
+    """
+    TAIL_TOKENS = 8
+
+    def __init__(self, tokenizer, prompt_length, stop_strings, max_sentences, stop_on_newline):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop_strings = stop_strings
+        self.max_sentences = max_sentences
+        self.stop_on_newline = stop_on_newline
+        self.rows = {}
+        self.reason = None
+        self.new_tokens = 0
+
+
+    def is_done(self, row, token_ids):
+        self.new_tokens = max(self.new_tokens, len(token_ids) - self.prompt_length)
+        if len(token_ids) <= self.prompt_length:
+            return False
+
+        state = self.rows.setdefault(row, {'sentences': 0, 'has_text': False, 'seen': self.prompt_length})
+        start = max(self.prompt_length, state['seen'] - self.TAIL_TOKENS)
+        tail = self.tokenizer.decode(token_ids[start:])
+        before = self.tokenizer.decode(token_ids[start:state['seen']])
+        new_from = len(os.path.commonprefix([tail, before]))
+        state['seen'] = len(token_ids)
+
+        reason = None
+        for stop_string in self.stop_strings:
+            if tail.find(stop_string, max(0, new_from - len(stop_string) + 1)) != -1:
+                reason = f'stop string {stop_string!r}'
+
+        newline = tail.find('\n', new_from)
+        if self.stop_on_newline and newline != -1 and (state['has_text'] or tail[new_from:newline].strip()):
+            reason = reason or 'newline'
+        state['has_text'] = state['has_text'] or bool(tail[new_from:].strip())
+
+        state['sentences'] += sum(1 for match in SENTENCE_END.finditer(tail) if match.end() > new_from)
+        if self.max_sentences and state['sentences'] >= self.max_sentences:
+            reason = reason or f'{self.max_sentences} sentences'
+
+        if reason is not None:
+            self.reason = reason
+        return reason is not None
+
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.tensor([self.is_done(row, ids.tolist()) for row, ids in enumerate(input_ids)],
+                            dtype=torch.bool, device=input_ids.device)
+
+
+def cache_bytes(cache):
+    return sum(tensor.numel() * tensor.element_size() for tensor in cache.key_cache + cache.value_cache)
 
 
 class TextGeneration:
@@ -15,16 +146,238 @@ class TextGeneration:
         logging.info('Initialize text generation tokenizer')
 
         logging.info('Loading text genearation if this is the first time ...')
-        self.model = LlamaForCausalLM.from_pretrained(lc.model_cache)
+        self.model = self.load_model(lc.model_cache, LlamaForCausalLM)
         
         logging.info('Initialize text generation model')
 
+        self.draft_model = None
+        self.forward_counts = threading.local()
+        if lc.draft_model_path:
+            self.draft_model = self.load_model(lc.draft_model_path, AutoModelForCausalLM)
+            self.draft_model.generation_config.num_assistant_tokens = lc.num_assistant_tokens
+            self.draft_model.generation_config.num_assistant_tokens_schedule = 'constant'
+            self.model.register_forward_hook(self.count_forward('main'))
+            self.draft_model.register_forward_hook(self.count_forward('draft'))
+            logging.info(f'Assisted decoding enabled with draft model {lc.draft_model_path}')
+
         self.temperature = lc.temperature
         self.return_tensors = lc.return_tensors
         self.max_new_tokens = lc.max_new_tokens
         self.repetition_penalty = lc.repetition_penalty
+        self.stop_strings = lc.stop_strings
+        self.max_sentences = lc.max_sentences
+        self.stop_on_newline = lc.stop_on_newline
+        self.tokens_saved = 0
 
         logging.info('Initialize text generation module hyperparameters')
+
+        self.response_cache = None
+        if lc.response_cache:
+            self.response_cache = self.build_response_cache()
+
+        self.prefix_cache = {}
+        if lc.prefix_cache:
+            self.build_prefix_cache(lc.prefix_cache_max_mb * 1024 * 1024)
+            self.report_prefix_cache()
+
+        self.scheduler = None
+        if lc.continuous_batching:
+            self.scheduler = GenerationScheduler(self.model,
+                                                 max_batch_size=lc.max_batch_size,
+                                                 repetition_penalty=self.repetition_penalty)
+            logging.info(f'Continuous batching enabled with up to {lc.max_batch_size} sequences')
+            if self.draft_model is not None:
+                logging.warning('Requests through the continuous-batching scheduler do not use the draft model.')
+
+
+    def load_model(self, model_path, model_class):
+        """Loads the model once in the configured dtype and places it on its device.
+
+        Safetensors checkpoints are memory-mapped and low_cpu_mem_usage skips
+        the randomly initialized copy, so peak memory stays close to one set of
+        weights. On CPU the linear layers can additionally be quantized to int8.
+        """
+        if lc.torch_dtype not in TORCH_DTYPES:
+            raise ValueError(f'Unknown torch_dtype for text generation: {lc.torch_dtype}')
+
+        dtype = TORCH_DTYPES[lc.torch_dtype]
+        quantize = lc.quantize_int8 and self.device.type == 'cpu'
+        if dtype == torch.float16 and self.device.type == 'cpu':
+            logging.warning('float16 is not supported well on CPU, loading the text generation model in float32.')
+            dtype = torch.float32
+        if quantize and dtype != torch.float32:
+            logging.warning('int8 dynamic quantization needs float32 weights, loading the text generation model in float32.')
+            dtype = torch.float32
+
+        start_time = time.time()
+        model = model_class.from_pretrained(model_path,
+                                            torch_dtype=dtype,
+                                            low_cpu_mem_usage=True).to(self.device).eval()
+
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        precision = 'int8' if quantize else str(dtype).replace('torch.', '')
+        log_resource_usage(f'Loaded {model_path} ({precision} on {self.device}) in {time.time() - start_time:.2f}s')
+        return model
+
+
+    def count_forward(self, name):
+        """Forward hook counting model calls of the current thread's generation."""
+        def hook(module, args, output):
+            counts = getattr(self.forward_counts, 'counts', None)
+            if counts is not None:
+                counts[name] += 1
+        return hook
+
+
+    def generate(self, generation_kwargs, **kwargs):
+        """model.generate, assisted by the draft model when one is configured.
+
+        With a draft model, every main-model pass verifies the drafted tokens
+        and keeps the accepted ones plus one of its own, so the accepted draft
+        tokens are the new tokens minus the main-model passes. The ratio of new
+        tokens to main-model passes is logged as the estimated speedup.
+        """
+        if self.draft_model is None:
+            with torch.no_grad():
+                return self.model.generate(**generation_kwargs, **kwargs)
+
+        self.forward_counts.counts = {'main': 0, 'draft': 0}
+        try:
+            with torch.no_grad():
+                output = self.model.generate(**generation_kwargs, assistant_model=self.draft_model, **kwargs)
+            counts = self.forward_counts.counts
+        finally:
+            self.forward_counts.counts = None
+
+        new_tokens = output.shape[1] - generation_kwargs['input_ids'].shape[1]
+        accepted = max(new_tokens - counts['main'], 0)
+        logging.info(f'Assisted decoding accepted {accepted}/{counts["draft"]} draft tokens '
+                     f'({accepted / max(counts["draft"], 1):.0%}), {new_tokens} tokens in {counts["main"]} '
+                     f'main-model passes (estimated speedup {new_tokens / max(counts["main"], 1):.2f}x)')
+        return output
+
+
+    def build_response_cache(self):
+        """Local LRU of final answers, optionally backed by redis so all workers share them.
+
+        The key prefix hashes the model and generation settings, so answers
+        made with a different configuration are never served.
+        """
+        settings = (f'{lc.model_cache}|{lc.max_new_tokens}|{lc.temperature}|{lc.repetition_penalty}|'
+                    f'{lc.stop_strings}|{lc.max_sentences}|{lc.stop_on_newline}')
+        prefix = f"llm-response:{hashlib.sha256(settings.encode('utf-8')).hexdigest()[:12]}:"
+
+        redis_cache = None
+        if lc.response_cache_redis:
+            redis_cache = RedisCache(Config.REDIS_URL,
+                                     prefix=prefix,
+                                     ttl_seconds=lc.response_cache_redis_ttl_seconds,
+                                     max_value_bytes=lc.response_cache_max_value_bytes)
+
+        return TieredCache(LRUCache(lc.response_cache_entries,
+                                    lc.response_cache_bytes,
+                                    ttl_seconds=lc.response_cache_ttl_seconds),
+                           redis_cache)
+
+
+    def response_cache_key(self, input_text, emotion, max_new_tokens=None):
+        return f'{emotion}|{max_new_tokens or self.max_new_tokens}|{normalize_text(input_text)}'
+
+
+    def cached_response(self, cache_key):
+        if self.response_cache is None:
+            return None
+
+        answer = self.response_cache.get(cache_key)
+        logging.info(f"Response cache {'hit' if answer is not None else 'miss'}, stats: {self.response_cache.stats()}")
+        return answer
+
+
+    def cache_response(self, cache_key, answer):
+        if self.response_cache is not None and answer:
+            self.response_cache.put(cache_key, answer)
+
+
+    def instruction_prefix(self, emotion):
+        """Instruction part of the prompt, shared by every request with this emotion."""
+        if emotion not in EMOTION_PROMPT_WORDS:
+            raise ValueError(f'Unknown emotion for text generation: {emotion}')
+        return (
+            f"The current emotional is {EMOTION_PROMPT_WORDS[emotion]}. Please respond the below input in a manner that aligns with their current emotional and as short as possible."
+            f"\n\n"
+        )
+
+
+    def build_prompt(self, input_text, emotion):
+        return self.instruction_prefix(emotion) + f"Input: {input_text}\nResponse:"
+
+
+    def build_prefix_cache(self, max_bytes):
+        """Prefills the instruction prefix of every emotion once and keeps its KV cache.
+
+        Prefixes are cached in EMOTION_PROMPT_WORDS order until max_bytes is
+        used up; emotions that do not fit fall back to a full prefill.
+        """
+        start_time = time.time()
+        used_bytes = 0
+        for emotion in EMOTION_PROMPT_WORDS:
+            prefix_ids = self.tokenizer(self.instruction_prefix(emotion),
+                                        return_tensors=self.return_tensors).input_ids.to(self.device)
+            with torch.no_grad():
+                cache = self.model(prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+
+            size = cache_bytes(cache)
+            if used_bytes + size > max_bytes:
+                logging.warning(f'Prefix cache budget of {max_bytes} bytes reached, not caching "{emotion}" and later emotions.')
+                break
+
+            used_bytes += size
+            self.prefix_cache[emotion] = (prefix_ids, cache)
+
+        logging.info(f'Cached {len(self.prefix_cache)} prompt prefixes ({used_bytes / 2**20:.1f} MB) '
+                     f'in {time.time() - start_time}s')
+
+
+    def prefix_past(self, emotion, input_ids):
+        """Copy of the cached prefix KV for this prompt, or None when it has to be prefilled in full.
+
+        The cache is only reused when the prompt tokenizes to the cached prefix
+        ids followed by the request part, so a token merge across the boundary
+        can never change the output. generate() extends the cache in place,
+        hence the copy.
+        """
+        entry = self.prefix_cache.get(emotion)
+        if entry is None:
+            return None
+
+        prefix_ids, cache = entry
+        prefix_length = prefix_ids.shape[1]
+        if input_ids.shape[1] <= prefix_length or not torch.equal(input_ids[0, :prefix_length], prefix_ids[0]):
+            return None
+
+        logging.info(f'Reusing {prefix_length} cached prefix tokens, prefilling {input_ids.shape[1] - prefix_length}')
+        return copy.deepcopy(cache)
+
+
+    def report_prefix_cache(self):
+        """Logs the time to first token for a sample request with and without the prefix cache."""
+        emotion = next(iter(self.prefix_cache), None)
+        if emotion is None:
+            return
+
+        inputs = self.tokenizer(self.build_prompt('Hello, how are you doing today?', emotion),
+                                return_tensors=self.return_tensors).to(self.device)
+        latencies = []
+        for past_key_values in (None, self.prefix_past(emotion, inputs['input_ids'])):
+            start_time = time.time()
+            with torch.no_grad():
+                self.model.generate(**inputs, past_key_values=past_key_values, max_new_tokens=1)
+            latencies.append(time.time() - start_time)
+
+        logging.info(f'Time to first token: {latencies[0]:.3f}s with full prefill, '
+                     f'{latencies[1]:.3f}s with the prefix cache ({latencies[0] / max(latencies[1], 1e-9):.1f}x)')
     
 
     def postprocess_text(self, text):
@@ -35,77 +388,137 @@ class TextGeneration:
             logging.warning("Response pattern not found in text.")
             answer = text  
 
+        # Cut first: <|end_of_text|> may itself be a stop string.
+        answer = cut_at_stop_strings(answer, self.stop_strings)
         answer = re.sub(r"<\|end_of_text\|>", "", answer).strip()
 
         answer = answer.replace("\n", " ").strip()
-        
-        last_full_stop_pos = answer.rfind(".")
-        
-        if last_full_stop_pos != -1:
-            return answer[:last_full_stop_pos + 1].strip()
-        else:
-            return answer.strip()
 
+        return trim_to_sentences(answer, self.max_sentences)
 
-    def run(self, input_text, emotion):
-        logging.info('Starting text generation inference process')
 
-        self.model.to(self.device)
+    def generation_kwargs(self, input_text, emotion, max_new_tokens=None):
+        inputs = self.tokenizer(self.build_prompt(input_text, emotion),
+                                return_tensors=self.return_tensors).to(self.device)
+        stopping_criteria = ResponseStoppingCriteria(self.tokenizer,
+                                                     prompt_length=inputs['input_ids'].shape[1],
+                                                     stop_strings=self.stop_strings,
+                                                     max_sentences=self.max_sentences,
+                                                     stop_on_newline=self.stop_on_newline)
+        return dict(**inputs,
+                    past_key_values=self.prefix_past(emotion, inputs['input_ids']),
+                    max_new_tokens=max_new_tokens or self.max_new_tokens,
+                    temperature=self.temperature,
+                    repetition_penalty=self.repetition_penalty,
+                    stopping_criteria=StoppingCriteriaList([stopping_criteria]))
 
-        if emotion == 'sad':
-            prompt = (
-                f"The current emotional is sad. Please respond the below input in a manner that aligns with their current emotional and as short as possible."
-                f"\n\nInput: {input_text}\nResponse:"
-            )
-        
-        elif emotion == 'joy':
-            prompt = (
-                f"The current emotional is happy. Please respond the below input in a manner that aligns with their current emotional and as short as possible."
-                f"\n\nInput: {input_text}\nResponse:"
-            )
-        
-        elif emotion == 'fear':
-            prompt = (
-                f"The current emotional is fear. Please respond the below input in a manner that aligns with their current emotional and as short as possible."
-                f"\n\nInput: {input_text}\nResponse:"
-            )
-        
-        elif emotion == 'anger':
-            prompt = (
-                f"The current emotional is angry. Please respond the below input in a manner that aligns with their current emotional and as short as possible."
-                f"\n\nInput: {input_text}\nResponse:"
-            )
-        
-        elif emotion == 'surprise':
-            prompt = (
-                f"The current emotional is surprised. Please respond the below input in a manner that aligns with their current emotional and as short as possible."
-                f"\n\nInput: {input_text}\nResponse:"
-            )
-        
-        elif emotion == 'neutral':
-            prompt = (
-                f"The current emotional is neutral. Please respond the below input in a manner that aligns with their current emotional and as short as possible."
-                f"\n\nInput: {input_text}\nResponse:"
-            )
 
+    def record_stop(self, generation_kwargs):
+        """Logs why generation ended early and how many of the token budget it saved."""
+        stopping_criteria = generation_kwargs['stopping_criteria'][0]
+        if stopping_criteria.reason is None:
+            return
 
-        inputs = self.tokenizer(prompt, return_tensors=self.return_tensors).to(self.device)
+        new_tokens = stopping_criteria.new_tokens
+        saved = generation_kwargs['max_new_tokens'] - new_tokens
+        self.tokens_saved += saved
+        logging.info(f'Stopped on {stopping_criteria.reason} after {new_tokens} tokens, saved {saved} tokens '
+                     f'({self.tokens_saved} in total)')
+
+
+    def run(self, input_text, emotion, max_new_tokens=None):
+        logging.info('Starting text generation inference process')
+
+        cache_key = self.response_cache_key(input_text, emotion, max_new_tokens)
+        cached_answer = self.cached_response(cache_key)
+        if cached_answer is not None:
+            return cached_answer
+
+        generation_kwargs = self.generation_kwargs(input_text, emotion, max_new_tokens)
 
         start_time = time.time()
-        with torch.no_grad():
-            output = self.model.generate(**inputs, 
-                                         max_new_tokens=self.max_new_tokens, 
-                                         temperature=self.temperature, 
-                                         repetition_penalty=self.repetition_penalty)
+        if self.scheduler is not None:
+            token_ids = self.scheduler.submit(generation_kwargs['input_ids'],
+                                              max_new_tokens=generation_kwargs['max_new_tokens'],
+                                              past_key_values=generation_kwargs['past_key_values'],
+                                              stopping_criteria=generation_kwargs['stopping_criteria'][0])
+            output = torch.tensor([token_ids])
+        else:
+            output = self.generate(generation_kwargs)
 
         answer = self.tokenizer.decode(output[0])
         end_time = time.time()
 
+        new_tokens = output.shape[1] - generation_kwargs['input_ids'].shape[1]
+        logging.info(f'Generated {new_tokens} tokens at {new_tokens / max(end_time - start_time, 1e-9):.1f} tokens/s')
+        self.record_stop(generation_kwargs)
+
         logging.info(f'Text before preprocessing: {answer}')
 
         processed_answer = self.postprocess_text(answer)
         
         logging.info(f'Final generated text: {processed_answer}')
 
+        self.cache_response(cache_key, processed_answer)
+
         logging.info(f'Finish LLM module in {end_time - start_time}s')
         return processed_answer
+
+
+    def stream(self, input_text, emotion):
+        """Yields the response one complete sentence at a time while generation continues.
+
+        generate() runs in a background thread and feeds a TextIteratorStreamer.
+        Sentences are trimmed and capped at max_sentences with the same rule as
+        run(), trim_to_sentences, so both paths produce and cache the same answer.
+        """
+        logging.info('Starting streaming text generation')
+
+        cache_key = self.response_cache_key(input_text, emotion)
+        cached_answer = self.cached_response(cache_key)
+        if cached_answer is not None:
+            complete, rest = split_sentences(cached_answer)
+            yield from complete + ([rest.strip()] if rest.strip() else [])
+            return
+
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        generation_kwargs = self.generation_kwargs(input_text, emotion)
+        errors = []
+
+        def generate():
+            try:
+                self.generate(generation_kwargs, streamer=streamer)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        start_time = time.time()
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+
+        pending = ''
+        sentences = []
+        for new_text in streamer:
+            complete, pending = split_sentences(
+                cut_at_stop_strings(pending + new_text, self.stop_strings).replace('\n', ' '))
+            for sentence in complete:
+                if self.max_sentences and len(sentences) >= self.max_sentences:
+                    break
+                if not sentences:
+                    logging.info(f'First sentence generated in {time.time() - start_time}s')
+                sentences.append(sentence)
+                yield sentence
+
+        thread.join()
+        if errors:
+            raise errors[0]
+        self.record_stop(generation_kwargs)
+
+        last = final_sentence(pending, bool(sentences))
+        if last and not (self.max_sentences and len(sentences) >= self.max_sentences):
+            sentences.append(last)
+            yield last
+
+        self.cache_response(cache_key, ' '.join(sentences))
+
+        logging.info(f'Finish streaming LLM module with {len(sentences)} sentences in {time.time() - start_time}s')
@@ -0,0 +1,85 @@
+import os
+import struct
+import numpy as np
+
+
+class SegmentBuffer:
+    """Growable byte buffer that collects the frames of one speech segment.
+
+    Frames are copied once into a preallocated bytearray that doubles when it
+    runs out of space. detach() hands the bytes over as an int16 view without
+    copying and starts a fresh buffer for the next segment.
+    """
+    def __init__(self, initial_bytes):
+        self.initial_bytes = initial_bytes
+        self.reset()
+
+
+    def reset(self):
+        self.buffer = bytearray(self.initial_bytes)
+        self.length = 0
+
+
+    def __len__(self):
+        return self.length
+
+
+    def append(self, frame):
+        end = self.length + len(frame)
+        if end > len(self.buffer):
+            grown = bytearray(max(end, 2 * len(self.buffer)))
+            grown[:self.length] = memoryview(self.buffer)[:self.length]
+            self.buffer = grown
+
+        self.buffer[self.length:end] = frame
+        self.length = end
+
+
+    def detach(self):
+        """Returns the collected samples as an int16 view and resets the buffer."""
+        segment = np.frombuffer(self.buffer, dtype=np.int16, count=self.length // 2)
+        self.reset()
+        return segment
+
+
+def mmap_wav(file_path):
+    """Memory-maps the PCM data chunk of a WAV file.
+
+    Returns the samples as a read-only int16 array together with the sample
+    rate, channel count and bits per sample from the fmt chunk.
+    """
+    with open(file_path, 'rb') as file:
+        riff, _, wave_id = struct.unpack('<4sI4s', file.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError(f"{file_path} is not a RIFF/WAVE file")
+
+        fmt = None
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                raise ValueError(f"No data chunk found in {file_path}")
+
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', file.read(16))
+                file.seek(chunk_size - 16 + (chunk_size & 1), os.SEEK_CUR)
+            elif chunk_id == b'data':
+                data_offset = file.tell()
+                break
+            else:
+                file.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+    if fmt is None:
+        raise ValueError(f"No fmt chunk found before the data chunk in {file_path}")
+
+    audio_format, channels, rate, _, _, bits_per_sample = fmt
+    if audio_format not in (1, 0xFFFE) or bits_per_sample != 16:
+        raise ValueError(f"Only 16-bit PCM WAV is supported, got format {audio_format} with {bits_per_sample} bits")
+
+    data_size = min(chunk_size, os.path.getsize(file_path) - data_offset)
+    num_samples = data_size // 2
+    if num_samples == 0:
+        return np.zeros(0, dtype=np.int16), rate, channels, bits_per_sample
+
+    samples = np.memmap(file_path, dtype='<i2', mode='r', offset=data_offset, shape=(num_samples,))
+    return samples, rate, channels, bits_per_sample
@@ -0,0 +1,279 @@
+import os
+import math
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+from src.utils.common import make_directory
+
+
+def stable_hash(text):
+    """64-bit hash that is identical across processes, unlike hash()."""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def edit_distance(source, target, max_distance):
+    """Optimal string alignment (Damerau-Levenshtein) distance, or max_distance + 1 past the cutoff."""
+    if abs(len(source) - len(target)) > max_distance:
+        return max_distance + 1
+
+    previous_previous = None
+    previous = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        current = [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = 0 if source[i - 1] == target[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (previous_previous is not None and i > 1 and j > 1
+                    and source[i - 1] == target[j - 2] and source[i - 2] == target[j - 1]):
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+
+    return previous[-1] if previous[-1] <= max_distance else max_distance + 1
+
+
+class SymSpellIndex:
+    """Symmetric-delete spelling index over a word-frequency dictionary.
+
+    The index is built once from the dictionary (and optional bigram) files
+    and stored as .npy arrays in index_dir: the words as one UTF-8 blob with
+    offsets, their counts, and sorted 64-bit hashes of every prefix delete
+    with the matching word ids. Later starts memory-map those arrays, so
+    loading is nearly free and the pages are shared between processes.
+
+    Each index lives in a subdirectory keyed by the index parameters and the
+    content of the input files, so changing any of them builds a new index.
+    Builds are written to a temporary directory and renamed into place, so a
+    partial build is never loaded.
+    """
+    ARRAYS = ['word_blob', 'word_offsets', 'word_counts', 'word_hashes', 'word_hash_ids',
+              'delete_hashes', 'delete_word_ids', 'bigram_hashes', 'bigram_counts']
+
+    def __init__(self, dictionary_path, bigram_path, index_dir, max_edit_distance, prefix_length):
+        self.max_edit_distance = max_edit_distance
+        self.prefix_length = prefix_length
+        self.index_dir = os.path.join(index_dir, self.index_key(dictionary_path, bigram_path))
+
+        if not os.path.isdir(self.index_dir):
+            self.build(dictionary_path, bigram_path)
+
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(self.array_path(name), mmap_mode='r'))
+
+        self.total_count = float(np.sum(self.word_counts, dtype=np.float64))
+        logging.info(f'Loaded SymSpell index with {len(self.word_counts)} words from {index_dir}')
+
+
+    def index_key(self, dictionary_path, bigram_path):
+        digest = hashlib.sha256(f'{self.max_edit_distance}|{self.prefix_length}'.encode('utf-8'))
+        for path in [dictionary_path, bigram_path]:
+            digest.update(b'|')
+            if path:
+                with open(path, 'rb') as file:
+                    for block in iter(lambda: file.read(1 << 20), b''):
+                        digest.update(block)
+        return digest.hexdigest()[:16]
+
+
+    def array_path(self, name, directory=None):
+        return os.path.join(directory or self.index_dir, f'{name}.npy')
+
+
+    def deletes(self, word):
+        """All strings reachable by deleting up to max_edit_distance characters of the word prefix."""
+        prefix = word[:self.prefix_length]
+        results = {prefix}
+        frontier = {prefix}
+        for _ in range(self.max_edit_distance):
+            frontier = {item[:i] + item[i + 1:] for item in frontier for i in range(len(item))}
+            results |= frontier
+        return results
+
+
+    def build(self, dictionary_path, bigram_path):
+        logging.info(f'Building SymSpell index from {dictionary_path} ...')
+        start_time = time.time()
+        build_dir = f'{self.index_dir}.tmp-{uuid.uuid4().hex}'
+        make_directory(build_dir)
+
+        words, counts = [], []
+        with open(dictionary_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) >= 2:
+                    words.append(parts[0].lower())
+                    counts.append(int(parts[1]))
+
+        word_hashes = np.array([stable_hash(word) for word in words], dtype=np.uint64)
+        word_order = np.argsort(word_hashes, kind='stable')
+
+        encoded = [word.encode('utf-8') for word in words]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(word) for word in encoded])
+
+        delete_hashes, delete_word_ids = [], []
+        for word_id, word in enumerate(words):
+            for delete in self.deletes(word):
+                delete_hashes.append(stable_hash(delete))
+                delete_word_ids.append(word_id)
+
+        delete_hashes = np.array(delete_hashes, dtype=np.uint64)
+        delete_word_ids = np.array(delete_word_ids, dtype=np.int32)
+        order = np.argsort(delete_hashes, kind='stable')
+
+        bigram_hashes, bigram_counts = [], []
+        if bigram_path:
+            with open(bigram_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    parts = line.split()
+                    if len(parts) >= 3:
+                        bigram_hashes.append(stable_hash(f'{parts[0].lower()} {parts[1].lower()}'))
+                        bigram_counts.append(int(parts[2]))
+
+        bigram_hashes = np.array(bigram_hashes, dtype=np.uint64)
+        bigram_counts = np.array(bigram_counts, dtype=np.int64)
+        bigram_order = np.argsort(bigram_hashes, kind='stable')
+
+        arrays = {
+            'word_blob': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'word_offsets': offsets,
+            'word_counts': np.array(counts, dtype=np.int64),
+            'word_hashes': word_hashes[word_order],
+            'word_hash_ids': word_order.astype(np.int32),
+            'delete_hashes': delete_hashes[order],
+            'delete_word_ids': delete_word_ids[order],
+            'bigram_hashes': bigram_hashes[bigram_order],
+            'bigram_counts': bigram_counts[bigram_order],
+        }
+        for name, array in arrays.items():
+            np.save(self.array_path(name, build_dir), array)
+
+        try:
+            os.rename(build_dir, self.index_dir)
+        except OSError:
+            # Another worker finished the same index first.
+            shutil.rmtree(build_dir, ignore_errors=True)
+            if not os.path.isdir(self.index_dir):
+                raise
+
+        logging.info(f'Built SymSpell index with {len(delete_hashes)} deletes in {time.time() - start_time}s')
+
+
+    def word(self, word_id):
+        start, end = self.word_offsets[word_id], self.word_offsets[word_id + 1]
+        return bytes(self.word_blob[start:end]).decode('utf-8')
+
+
+    def word_id(self, word):
+        """Id of an exact dictionary word, or None."""
+        key = np.uint64(stable_hash(word))
+        start = np.searchsorted(self.word_hashes, key, side='left')
+        end = np.searchsorted(self.word_hashes, key, side='right')
+        for word_id in self.word_hash_ids[start:end]:
+            if self.word(word_id) == word:
+                return int(word_id)
+        return None
+
+
+    def lookup(self, word):
+        """Returns (suggestion, distance, count) for the closest, most frequent word, or None."""
+        word_id = self.word_id(word)
+        if word_id is not None:
+            return word, 0, int(self.word_counts[word_id])
+
+        hashes = np.array([stable_hash(delete) for delete in self.deletes(word)], dtype=np.uint64)
+        starts = np.searchsorted(self.delete_hashes, hashes, side='left')
+        ends = np.searchsorted(self.delete_hashes, hashes, side='right')
+        candidate_ids = {int(word_id) for start, end in zip(starts, ends)
+                         for word_id in self.delete_word_ids[start:end]}
+
+        best = None
+        for candidate_id in candidate_ids:
+            candidate = self.word(candidate_id)
+            distance = edit_distance(word, candidate, self.max_edit_distance)
+            if distance > self.max_edit_distance:
+                continue
+            count = int(self.word_counts[candidate_id])
+            if best is None or (distance, -count) < (best[1], -best[2]):
+                best = (candidate, distance, count)
+        return best
+
+
+    def bigram_count(self, first, second):
+        key = np.uint64(stable_hash(f'{first} {second}'))
+        index = np.searchsorted(self.bigram_hashes, key)
+        if index < len(self.bigram_hashes) and self.bigram_hashes[index] == key:
+            return int(self.bigram_counts[index])
+        return 0
+
+
+    def log_probability(self, words):
+        """Log probability of a short word sequence, preferring bigram counts when available."""
+        if len(words) == 2:
+            count = self.bigram_count(*words)
+            if count:
+                return math.log(count / self.total_count)
+
+        score = 0.0
+        for word in words:
+            word_id = self.word_id(word)
+            count = self.word_counts[word_id] if word_id is not None else 0
+            score += math.log(max(count, 1) / self.total_count)
+        return score
+
+
+    def best_split(self, token):
+        """Best two-word split of token as (words, distance, log probability), or None."""
+        best = None
+        for i in range(1, len(token)):
+            left, right = self.lookup(token[:i]), self.lookup(token[i:])
+            if left is None or right is None:
+                continue
+
+            words = [left[0], right[0]]
+            candidate = (words, left[1] + right[1] + 1, self.log_probability(words))
+            if best is None or (candidate[1], -candidate[2]) < (best[1], -best[2]):
+                best = candidate
+        return best
+
+
+    def lookup_compound(self, text):
+        """Corrects a whole phrase word by word, merging and splitting words with bigram context."""
+        tokens = text.lower().split()
+        corrected = []
+        i = 0
+
+        while i < len(tokens):
+            token = tokens[i]
+            single = self.lookup(token)
+
+            # Merge a wrongly split word, e.g. "gree ting" -> "greeting".
+            if i + 1 < len(tokens):
+                merged = self.lookup(token + tokens[i + 1])
+                following = self.lookup(tokens[i + 1])
+                words = [single[0] if single else token, following[0] if following else tokens[i + 1]]
+                distance = (single[1] if single else len(token)) + (following[1] if following else len(tokens[i + 1]))
+                if merged is not None and (merged[1] + 1, -self.log_probability([merged[0]])) < \
+                        (distance, -self.log_probability(words)):
+                    corrected.append(merged[0])
+                    i += 2
+                    continue
+
+            # Split wrongly joined words, e.g. "thankyou" -> "thank you".
+            if single is None or single[1] > 0:
+                split = self.best_split(token)
+                if split is not None and (single is None or split[1] < single[1] or (
+                        split[1] == single[1] and split[2] > self.log_probability([single[0]]))):
+                    corrected.extend(split[0])
+                    i += 1
+                    continue
+
+            corrected.append(single[0] if single else token)
+            i += 1
+
+        return ' '.join(corrected)
@@ -1,23 +1,104 @@
-import torch
+import hashlib
 import logging
 
-from transformers import pipeline
-
 from src.config.app_config import Speech2TxtConfig as sc
+from src.utils.cache import DiskCache, LRUCache, TieredCache, normalize_text
+from src.module.processing.symspell import SymSpellIndex
 
 class TextProcessing:
     def __init__(self):
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.max_len_post_processing = sc.max_len_post_processing
+        self.batch_size = sc.correction_batch_size
+        self.length_ratio = sc.correction_length_ratio
+        self.length_margin = sc.correction_length_margin
+
+        self.engine = sc.correction_engine
+
+        if self.engine == 'symspell':
+            self.model = SymSpellIndex(
+                dictionary_path=sc.symspell_dictionary_path,
+                bigram_path=sc.symspell_bigram_path,
+                index_dir=sc.symspell_index_dir,
+                max_edit_distance=sc.symspell_max_edit_distance,
+                prefix_length=sc.symspell_prefix_length)
+        elif self.engine == 'transformer':
+            import torch
+            from transformers import pipeline
+
+            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+            self.model = pipeline(
+                sc.post_processing_task, 
+                model=sc.post_processing_model_cache, 
+                device=self.device)
+            self.tokenizer = self.model.tokenizer
+        else:
+            raise ValueError(f'Unknown correction engine: {self.engine}')
+
+        # Corrections from another engine, model or setting must never be served.
+        if self.engine == 'symspell':
+            settings = f'symspell|{self.model.index_dir}'
+        else:
+            settings = (f'transformer|{sc.post_processing_model_cache}|{sc.post_processing_task}|'
+                        f'{self.max_len_post_processing}|{self.length_ratio}|{self.length_margin}')
+        self.cache_prefix = f"{hashlib.sha256(settings.encode('utf-8')).hexdigest()[:12]}:"
 
-        self.model = pipeline(
-            sc.post_processing_task, 
-            model=sc.post_processing_model_cache, 
-            device=self.device)
+        disk_cache = None
+        if sc.correction_cache_path:
+            disk_cache = DiskCache(sc.correction_cache_path, sc.correction_cache_disk_entries)
+        self.cache = TieredCache(
+            LRUCache(sc.correction_cache_entries, sc.correction_cache_bytes),
+            disk_cache)
         
         logging.info('Initialize Speech Post Processing Module ...')
 
+
+    def generation_budget(self, input_lengths):
+        """Caps new tokens from the longest input, since corrections stay close to their input length."""
+        budget = int(max(input_lengths) * self.length_ratio) + self.length_margin
+        return min(budget, self.max_len_post_processing)
+
+
+    def correct_bucket(self, texts):
+        if self.engine == 'symspell':
+            return [self.model.lookup_compound(text) for text in texts]
+
+        import torch
+
+        inputs = self.tokenizer(texts,
+                                padding=True,
+                                truncation=True,
+                                max_length=self.max_len_post_processing,
+                                return_tensors='pt').to(self.model.device)
+
+        input_lengths = inputs['attention_mask'].sum(dim=1).tolist()
+        with torch.no_grad():
+            outputs = self.model.model.generate(**inputs, max_new_tokens=self.generation_budget(input_lengths))
+
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+
+    def text_post_processing_batch(self, texts):
+        """Corrects many segments with one padded generate call per length-sorted bucket.
+
+        Recurring phrases are served from the correction cache; only misses
+        reach the model.
+        """
+        keys = [normalize_text(text) for text in texts]
+        results = [self.cache.get(self.cache_prefix + key) for key in keys]
+
+        # Identical misses in one batch are generated once.
+        misses = sorted({key for key, result in zip(keys, results) if result is None}, key=len)
+        corrected = {}
+        for start in range(0, len(misses), self.batch_size):
+            bucket = misses[start:start + self.batch_size]
+            for key, text in zip(bucket, self.correct_bucket(bucket)):
+                corrected[key] = text.strip()
+                self.cache.put(self.cache_prefix + key, corrected[key])
+
+        results = [corrected[key] if result is None else result for key, result in zip(keys, results)]
+        logging.info(f'Correction cache stats: {self.cache.stats()}')
+        return results
+
     
     def text_post_processing(self, text):
-        return self.model(text, max_length=self.max_len_post_processing)[0]['generated_text']
-
+        return self.text_post_processing_batch([text])[0]
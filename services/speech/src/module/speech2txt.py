@@ -1,8 +1,10 @@
+import itertools
 import threading
 import pyaudio
 import webrtcvad
 import wave
 import time
+import uuid
 import numpy as np
 
 from queue import  Queue, Empty
@@ -11,10 +13,34 @@ from concurrent.futures import ThreadPoolExecutor
 from src.utils.common import *
 from src.config.app_config import Speech2TxtConfig as sc
 from src.module.processing.text_processing import TextProcessing
+from src.module.processing.audio_buffer import SegmentBuffer, mmap_wav
 from src.module.wav2vec2.wav2vec2_inference import Wav2vec2Inference
 
-WAV2VEC2_INIT = None
-TEXT_PROCESSING_INIT = None
+SPEECH2TXT_ENGINE = None
+SPEECH2TXT_ENGINE_LOCK = threading.Lock()
+
+# Sentinel that every stage forwards downstream once its input is exhausted.
+# An object rather than a string, so a transcript can never be mistaken for it.
+END_OF_STREAM = object()
+
+
+class SpeechJob:
+    """Per-request context carried through the long-lived engine stages."""
+    def __init__(self, input_audio_file_path=None):
+        self.job_id = uuid.uuid4().hex
+        self.input_audio_file_path = input_audio_file_path
+        self.live_record = input_audio_file_path is None
+        self.exit_event = threading.Event()
+        self.output_queue = Queue()
+        self.sequence = itertools.count()
+        self.reorder_buffer = None
+        self.start_time = time.time()
+        self.stage_timestamps = {}
+        self.correction_stats = {'corrected': 0, 'skipped': 0}
+
+    def mark(self, stage):
+        self.stage_timestamps.setdefault(stage, time.time() - self.start_time)
+
 
 class VADProcessor:
     """Handles Voice Activity Detection."""
@@ -22,11 +48,34 @@ class VADProcessor:
         self.device_name = device_name
         self.rate = sc.rate
         self.frame_duration = sc.frame_duration
-        self.audio = pyaudio.PyAudio()
+        self.audio = None
+        self.audio_lock = threading.Lock()
         self.format = pyaudio.paInt16
         self.chunk = int(sc.rate * sc.frame_duration / 1000)
-        self.vad = webrtcvad.Vad()
-        self.vad.set_mode(sc.vad_mode)
+        self.local = threading.local()
+        self.segment_buffer_bytes = int(sc.rate * sc.segment_buffer_seconds) * 2 * sc.channels
+        self.file_mode = sc.vad_file_mode
+        self.energy_threshold_db = sc.vad_energy_threshold_db
+        self.hangover_frames = sc.vad_hangover_frames
+        self.padding_frames = sc.vad_padding_frames
+
+
+    @property
+    def vad(self):
+        """webrtcvad keeps per-stream state, so every VAD thread gets its own instance."""
+        vad = getattr(self.local, 'vad', None)
+        if vad is None:
+            vad = self.local.vad = webrtcvad.Vad()
+            vad.set_mode(sc.vad_mode)
+        return vad
+
+
+    def get_audio(self):
+        """Creates the PyAudio instance on the first live stream only."""
+        with self.audio_lock:
+            if self.audio is None:
+                self.audio = pyaudio.PyAudio()
+            return self.audio
     
 
     @staticmethod
@@ -50,47 +99,146 @@ class VADProcessor:
         return result
 
 
-    def process_stream(self, asr_input_queue):
+    def process_job(self, job, asr_input_queue):
+        """Runs VAD for one job and always closes its stream, even on errors."""
+        try:
+            if job.live_record:
+                self.process_stream(job, asr_input_queue)
+            else:
+                self.process_file(job, asr_input_queue)
+        except Exception as e:
+            logging.error(f'VAD failed for job {job.job_id}: {e}')
+        finally:
+            job.mark('vad')
+            asr_input_queue.put((job, next(job.sequence), END_OF_STREAM))
+
+
+    def process_stream(self, job, asr_input_queue):
         """Processes audio from a stream and detects speech."""
         logging.info('Processing audio stream...')
-        microphones = VADProcessor.list_microphones(self.audio)
+        audio = self.get_audio()
+        microphones = VADProcessor.list_microphones(audio)
 
         selected_input_device_id = VADProcessor.get_input_device_id(
             self.device_name, microphones)
 
-        stream = self.audio.open(input_device_index=selected_input_device_id,
-                                 format=self.format,
-                                 channels=sc.channels,
-                                 rate=sc.rate,
-                                 input=True,
-                                 frames_per_buffer=self.chunk)
+        stream = audio.open(input_device_index=selected_input_device_id,
+                            format=self.format,
+                            channels=sc.channels,
+                            rate=sc.rate,
+                            input=True,
+                            frames_per_buffer=self.chunk)
         
-        frames = b''
+        frames = SegmentBuffer(self.segment_buffer_bytes)
 
-        while True:
-            if Speech2Txt.exit_event.is_set():
-                break
-            
-            frame = stream.read(self.chunk, exception_on_overflow=False)
-            is_speech = self.vad.is_speech(frame, self.rate)
+        try:
+            while True:
+                if job.exit_event.is_set():
+                    break
+                
+                frame = stream.read(self.chunk, exception_on_overflow=False)
+                is_speech = self.vad.is_speech(frame, self.rate)
 
-            if is_speech:
-                frames += frame
-            else:
-                if len(frames) > 1:
-                    asr_input_queue.put(frames)
-                frames = b''
+                if is_speech:
+                    frames.append(frame)
+                else:
+                    if len(frames) > 1:
+                        asr_input_queue.put((job, next(job.sequence), frames.detach()))
+        finally:
+            stream.stop_stream()
+            stream.close()
+
+
+    def speech_mask(self, samples):
+        """Classifies every frame of a mono int16 signal as speech or not.
+
+        Frames are strided views over the samples. A vectorized RMS energy
+        prefilter rejects quiet frames so webrtcvad only runs on candidates.
+        """
+        num_frames = len(samples) // self.chunk
+        frames = samples[:num_frames * self.chunk].reshape(num_frames, self.chunk)
 
+        energy_db = np.empty(num_frames, dtype=np.float32)
+        block = 4096
+        for start in range(0, num_frames, block):
+            block_frames = frames[start:start + block].astype(np.float32) / 32768
+            power = np.einsum('ij,ij->i', block_frames, block_frames) / self.chunk
+            energy_db[start:start + block] = 10 * np.log10(power + 1e-10)
 
-    def process_file(self, audio_file_path, asr_input_queue):
+        candidates = np.flatnonzero(energy_db > self.energy_threshold_db)
+        mask = np.zeros(num_frames, dtype=bool)
+        for index in candidates:
+            mask[index] = self.vad.is_speech(frames[index].tobytes(), self.rate)
+
+        logging.info(f'VAD prefilter kept {len(candidates)}/{num_frames} frames for webrtcvad')
+        return mask
+
+
+    def speech_segments(self, mask):
+        """Turns a per-frame speech mask into smoothed (start, end) sample offsets.
+
+        Each speech run is padded by vad_padding_frames on both sides, then runs
+        separated by at most vad_hangover_frames are merged so single-frame
+        dropouts do not split a segment.
+        """
+        edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        if len(starts) == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+
+        starts = np.maximum(starts - self.padding_frames, 0)
+        ends = np.minimum(ends + self.padding_frames, len(mask))
+
+        keep = (starts[1:] - ends[:-1]) > self.hangover_frames
+        starts = np.concatenate((starts[:1], starts[1:][keep]))
+        ends = np.concatenate((ends[:-1][keep], ends[-1:]))
+
+        return np.stack((starts, ends), axis=1) * self.chunk
+
+
+    def detect_file_segments(self, audio_file_path):
+        """Runs whole-file VAD on a memory-mapped WAV.
+
+        Returns the mapped samples and an array of (start, end) sample offsets.
+        """
+        samples, rate, channels, _ = mmap_wav(audio_file_path)
+        if rate != self.rate:
+            raise ValueError(f"Audio sample rate mismatch. Expected: {self.rate}, Got: {rate}")
+        if channels != 1:
+            raise ValueError(f"Only mono audio is supported, got {channels} channels")
+
+        return samples, self.speech_segments(self.speech_mask(samples))
+
+
+    def process_file(self, job, asr_input_queue):
         """Processes audio from a file."""
+        if self.file_mode == 'vectorized':
+            self.process_file_vectorized(job, asr_input_queue)
+        else:
+            self.process_file_frames(job, asr_input_queue)
+
+
+    def process_file_vectorized(self, job, asr_input_queue):
+        """Processes a whole file at once and queues segments as views of the mapping."""
+        logging.info('Processing audio file with vectorized VAD...')
+
+        samples, segments = self.detect_file_segments(job.input_audio_file_path)
+        for start, end in segments:
+            asr_input_queue.put((job, next(job.sequence), samples[start:end]))
+
+        logging.info(f'Detected {len(segments)} speech segments')
+
+
+    def process_file_frames(self, job, asr_input_queue):
+        """Processes audio from a file frame by frame, like a live stream."""
         logging.info('Processing audio file...')
 
-        with wave.open(audio_file_path, 'rb') as wf:
+        with wave.open(job.input_audio_file_path, 'rb') as wf:
             if wf.getframerate() != self.rate:
                 raise ValueError(f"Audio sample rate mismatch. Expected: {self.rate}, Got: {wf.getframerate()}")
             
-            frames = b''
+            frames = SegmentBuffer(self.segment_buffer_bytes)
 
             while True:
                 data = wf.readframes(self.chunk)
@@ -99,139 +247,314 @@ class VADProcessor:
 
                 is_speech = self.vad.is_speech(data, self.rate)
                 if is_speech:
-                    frames += data
+                    frames.append(data)
                 else:
                     if len(frames) > 1:
-                        asr_input_queue.put(frames)
-                    frames = b''
+                        asr_input_queue.put((job, next(job.sequence), frames.detach()))
 
-        asr_input_queue.put("close")
+
+class ReorderBuffer:
+    """Releases out-of-order ASR results of one job to the next stage in sequence order.
+
+    Results are dicts with the recognized text and its confidence.
+    """
+    def __init__(self, job, out_queue):
+        self.job = job
+        self.out_queue = out_queue
+        self.next_sequence = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def put(self, sequence, text):
+        with self.lock:
+            self.pending[sequence] = text
+            while self.next_sequence in self.pending:
+                text = self.pending.pop(self.next_sequence)
+                self.next_sequence += 1
+
+                if text is END_OF_STREAM:
+                    self.job.mark('asr')
+                    self.out_queue.put((self.job, END_OF_STREAM))
+                elif text['text']:
+                    self.out_queue.put((self.job, text))
+                    logging.info(f"Recognized Text: {text['text']} (confidence {text['confidence']:.3f})")
 
 
 class ASRProcessor:
     """Handles Automatic Speech Recognition."""
     def __init__(self, model):
         self.model = model
-
-    def process_audio(self, in_queue, out_queue):
-        """Processes audio frames and performs ASR."""
-        logging.info("Processing audio for ASR...")
-        while True:
-            audio_frames = in_queue.get()
-            if audio_frames == "close":
+        self.batch_size = sc.batch_size
+        self.batch_wait_seconds = sc.batch_wait_seconds
+        self.num_workers = sc.asr_workers
+
+    def collect_batch(self, in_queue):
+        """Drains the queue into a batch until it is full, the wait time expires or the engine shuts down."""
+        batch = []
+        closed = False
+
+        item = in_queue.get()
+        if item is END_OF_STREAM:
+            return batch, True
+        batch.append(item)
+
+        deadline = time.time() + self.batch_wait_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
                 break
+            try:
+                item = in_queue.get(timeout=remaining)
+            except Empty:
+                break
+            if item is END_OF_STREAM:
+                closed = True
+                break
+            batch.append(item)
+
+        return batch, closed
+
+    def transcribe_batch(self, batch):
+        """Transcribes the segments of a batch, which may mix several jobs."""
+        segments = [(job, sequence, segment) for job, sequence, segment in batch if segment is not END_OF_STREAM]
+        results = [{'text': "", 'confidence': 0.0}] * len(segments)
+
+        if segments:
+            try:
+                # Segments arrive as int16 views; scaling and normalization happen
+                # once, in float32, while building the model input.
+                results = self.model.speech_recognition_batch(
+                    [segment for _, _, segment in segments], return_confidence=True)
+            except Exception as e:
+                logging.error(f'ASR failed for a batch of {len(segments)} segments: {e}')
+
+        for (job, sequence, _), result in zip(segments, results):
+            job.reorder_buffer.put(sequence, {'text': result['text'].lower(), 'confidence': result['confidence']})
+
+        # End-of-stream markers carry the job's last sequence number, so the
+        # reorder buffer only releases them after every earlier segment.
+        for job, sequence, segment in batch:
+            if segment is END_OF_STREAM:
+                job.reorder_buffer.put(sequence, END_OF_STREAM)
+
+    def asr_worker(self, in_queue):
+        """Transcribes batches of (job, sequence, segment) items until the engine shuts down."""
+        try:
+            while True:
+                batch, closed = self.collect_batch(in_queue)
 
-            float64_buffer = np.frombuffer(audio_frames, dtype=np.int16) / 32767
-            text = self.model.speech_recognition(float64_buffer).lower()
+                if batch:
+                    self.transcribe_batch(batch)
+
+                if closed:
+                    break
+        finally:
+            # Hand the shutdown sentinel on so every other worker also stops.
+            in_queue.put(END_OF_STREAM)
 
-            if text:
-                out_queue.put(text)
-                logging.info(f"Recognized Text: {text}")
+    def start(self, in_queue):
+        """Starts the long-running pool of ASR workers."""
+        logging.info(f"Starting {self.num_workers} ASR workers...")
+        self.workers = [
+            threading.Thread(target=self.asr_worker, args=(in_queue,), daemon=True)
+            for _ in range(self.num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
 
 
 class TextProcessor:
-    """Handles Text Processing (e.g., Spelling Correction)."""
+    """Handles Text Processing (e.g., Spelling Correction).
+
+    Segments whose ASR confidence reaches correction_confidence_threshold, or
+    that are shorter than correction_min_words, skip the corrector.
+    """
     def __init__(self, processor):
         self.processor = processor
-
-    def correct_text(self, input_queue, output_queue):
-        """Processes text for corrections."""
+        self.batch_size = sc.correction_batch_size
+        self.batch_wait_seconds = sc.correction_batch_wait_seconds
+        self.confidence_threshold = sc.correction_confidence_threshold
+        self.min_words = sc.correction_min_words
+
+        self.corrected_segments = 0
+        self.skipped_segments = 0
+        self.correction_seconds = 0.0
+
+    def needs_correction(self, segment):
+        if segment['confidence'] >= self.confidence_threshold:
+            return False
+        return len(segment['text'].split()) >= self.min_words
+
+    def seconds_per_correction(self):
+        if self.corrected_segments == 0:
+            return 0.0
+        return self.correction_seconds / self.corrected_segments
+
+    def collect_pending(self, input_queue):
+        """Drains pending (job, segment) items up to the batch size or wait time."""
+        pending = [input_queue.get()]
+        if pending[0] is END_OF_STREAM:
+            return [], True
+
+        deadline = time.time() + self.batch_wait_seconds
+        while len(pending) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                item = input_queue.get(timeout=remaining)
+            except Empty:
+                break
+            if item is END_OF_STREAM:
+                return pending, True
+            pending.append(item)
+
+        return pending, False
+
+    def correct_pending(self, pending):
+        """Corrects the gated texts of the pending items in one batch and routes results in order."""
+        segments = [segment for _, segment in pending if segment is not END_OF_STREAM]
+        selected = [segment['text'] for segment in segments if self.needs_correction(segment)]
+
+        corrected = {}
+        if selected:
+            start_time = time.time()
+            try:
+                corrected = dict(zip(selected, self.processor.text_post_processing_batch(selected)))
+                self.correction_seconds += time.time() - start_time
+                self.corrected_segments += len(selected)
+            except Exception as e:
+                logging.error(f'Text correction failed for a batch of {len(selected)} segments: {e}')
+
+        for job, segment in pending:
+            if segment is END_OF_STREAM:
+                self.finish_job(job)
+                continue
+
+            if self.needs_correction(segment):
+                job.correction_stats['corrected'] += 1
+            else:
+                job.correction_stats['skipped'] += 1
+                self.skipped_segments += 1
+            job.output_queue.put(corrected.get(segment['text'], segment['text']))
+
+    def finish_job(self, job):
+        stats = job.correction_stats
+        total = stats['skipped'] + stats['corrected']
+        skip_rate = stats['skipped'] / total if total else 0.0
+        saved_seconds = stats['skipped'] * self.seconds_per_correction()
+
+        logging.info(f"Correction gating skipped {stats['skipped']}/{total} segments "
+                     f"(skip rate {skip_rate:.2f}, ~{saved_seconds:.3f}s saved)")
+        job.mark('text_correction')
+        job.output_queue.put(END_OF_STREAM)
+
+    def correct_text(self, input_queue):
+        """Processes text for corrections and routes it to the owning job."""
         logging.info("Processing text for corrections...")
         while True:
-            text = input_queue.get()
-            if text == "close":
-                break
+            pending, closed = self.collect_pending(input_queue)
 
-            corrected_text = self.processor.text_post_processing(text)
-            output_queue.put(corrected_text)
+            if pending:
+                self.correct_pending(pending)
 
+            if closed:
+                break
 
-class Speech2Txt:
-    """Main Speech-to-Text Pipeline."""
-    exit_event = threading.Event()
 
-    def __init__(self, input_audio_file_path):
-        global WAV2VEC2_INIT, TEXT_PROCESSING_INIT
+class Speech2TxtEngine:
+    """Long-lived speech-to-text engine created once per worker.
 
-        self.input_audio_file_path = input_audio_file_path
-        self.device_name = sc.device_name
-        self.asr_output_queue = Queue()
-        self.asr_input_queue = Queue()
-        self.corrected_output_queue = Queue()
+    Models, queues and stage threads are set up once; each request only
+    submits a SpeechJob and reads corrected text from its own output queue.
+    """
+    def __init__(self):
+        with ThreadPoolExecutor() as executor:
+            future_wav2vec2 = executor.submit(Wav2vec2Inference)
+            future_txt_processing = executor.submit(TextProcessing)
 
-        if (WAV2VEC2_INIT is None) or (TEXT_PROCESSING_INIT is None):
-            with ThreadPoolExecutor() as executor:
-                future_wav2vec2 = executor.submit(Wav2vec2Inference)
-                future_txt_processing = executor.submit(TextProcessing)
+            self.wav2vec2 = future_wav2vec2.result()
+            self.txt_processing = future_txt_processing.result()
 
-                if WAV2VEC2_INIT is None:
-                    WAV2VEC2_INIT = future_wav2vec2.result()
-                
-                if TEXT_PROCESSING_INIT is None:
-                    TEXT_PROCESSING_INIT = future_txt_processing.result()
-
-        self.wav2vec2 = WAV2VEC2_INIT
-        self.txt_processing = TEXT_PROCESSING_INIT
+        self.asr_input_queue = Queue()
+        self.asr_output_queue = Queue()
 
-        self.vad_processor = VADProcessor()
+        self.vad_processor = VADProcessor(sc.device_name)
         self.asr_processor = ASRProcessor(self.wav2vec2)
         self.text_processor = TextProcessor(self.txt_processing)
 
-
-    def start(self):
-        """Start the Speech-to-Text process."""
-        logging.info("Starting Speech-to-Text process...")
-        
-        # if self.live_record:
-        #     self.vad_thread = threading.Thread(
-        #         target=self.vad_processor.process_stream,
-        #         args=(self.device_name, self.asr_input_queue),
-        #     )
-        # else:
-
-        self.vad_thread = threading.Thread(
-            target=self.vad_processor.process_file,
-            args=(self.input_audio_file_path, self.asr_input_queue),
-        )
-        self.vad_thread.start()
-
-        self.asr_thread = threading.Thread(
-            target=self.asr_processor.process_audio,
-            args=(self.asr_input_queue, self.asr_output_queue),
-        )
-        self.asr_thread.start()
-
+        self.vad_executor = ThreadPoolExecutor(max_workers=sc.vad_workers, thread_name_prefix='vad')
+        self.asr_processor.start(self.asr_input_queue)
         self.text_thread = threading.Thread(
             target=self.text_processor.correct_text,
-            args=(self.asr_output_queue, self.corrected_output_queue),
+            args=(self.asr_output_queue,),
+            daemon=True,
         )
         self.text_thread.start()
 
+        logging.info('Initialized Speech-to-Text engine ...')
+
+
+    def submit(self, input_audio_file_path=None):
+        """Queues a file (or a live stream when no path is given) and returns its job."""
+        job = SpeechJob(input_audio_file_path)
+        job.reorder_buffer = ReorderBuffer(job, self.asr_output_queue)
+        self.vad_executor.submit(self.vad_processor.process_job, job, self.asr_input_queue)
+        return job
+
+
+    def shutdown(self):
+        """Stops the stage threads; only needed when the worker process exits."""
+        self.vad_executor.shutdown(wait=False)
+        self.asr_input_queue.put(END_OF_STREAM)
+        self.asr_output_queue.put(END_OF_STREAM)
+
+
+def get_engine():
+    global SPEECH2TXT_ENGINE
+
+    with SPEECH2TXT_ENGINE_LOCK:
+        if SPEECH2TXT_ENGINE is None:
+            SPEECH2TXT_ENGINE = Speech2TxtEngine()
+    return SPEECH2TXT_ENGINE
+
+
+class Speech2Txt:
+    """Main Speech-to-Text Pipeline."""
+    def __init__(self, input_audio_file_path):
+        self.input_audio_file_path = input_audio_file_path
+        self.live_record = input_audio_file_path is None
+        self.engine = get_engine()
+        self.job = None
+
 
     def stop(self):
         """Stop the Speech-to-Text process."""
         logging.info("Stopping Speech-to-Text process...")
-        Speech2Txt.exit_event.set()
-        self.asr_input_queue.put("close")
-        self.asr_output_queue.put("close")
-        self.corrected_output_queue.put(None)
-
-        self.vad_thread.join()
-        self.asr_thread.join()
-        self.text_thread.join()
+        if self.job is not None:
+            self.job.exit_event.set()
 
 
     def run(self):
         """Run the pipeline."""
-        start_time = time.time()
-        self.start()
+        logging.info("Starting Speech-to-Text process...")
+        self.job = self.engine.submit(self.input_audio_file_path)
         final_text = ""
 
+        # File input ends with an explicit end-of-stream; the silence timeout is
+        # only a safety net for live input.
+        timeout = sc.silence_limit_seconds if self.live_record else None
+
         try:
             while True:
                 try:
-                    text = self.corrected_output_queue.get(timeout=sc.silence_limit_seconds)
+                    text = self.job.output_queue.get(timeout=timeout)
+                    if text is END_OF_STREAM:
+                        logging.info("End of stream reached. Stopping.")
+                        break
+
                     if text:
+                        self.job.mark('first_text')
                         logging.info(f"Corrected Text: {text}")
                         final_text += text + " "
                 except Empty:
@@ -241,9 +564,9 @@ class Speech2Txt:
             logging.info("Interrupted by user.")
         finally:
             self.stop()
-        end_time = time.time()
+        self.job.mark('collector')
+        inference_time = self.job.stage_timestamps['collector']
 
-        logging.info(f"Final Text: {final_text} with inference time: {end_time-start_time}s")
+        logging.info(f"Stage timestamps (s since start): {self.job.stage_timestamps}")
+        logging.info(f"Final Text: {final_text} with inference time: {inference_time}s")
         return final_text
-    
-
@@ -1,11 +1,11 @@
+import time
 import logging
 
 from concurrent.futures import ThreadPoolExecutor
 
-from src.module.llm import TextGeneration
+from src.utils.common import log_resource_usage
 from src.module.emotion_analysis import EmotionAnalysis
 from src.module.speech2txt import Speech2Txt
-from src.module.txt2speech import Txt2Speech
 from src.schema.speech_system_schema import (InputSpeechSystemModel,
                                              ResultSpeechSystemModel,
                                              OutputSpeechSystemModel,
@@ -16,15 +16,30 @@ TEXT_GENERATION_INIT = None
 EMOTION_ANALYSIS_INIT = None
 TXT_TO_SPEECH_INIT = None
 
+
+# The LLM and TTS stacks always pull in torch, so they are imported on first
+# use to keep the ONNX speech-to-text and emotion path torch-free.
+def load_text_generation():
+    from src.module.llm import TextGeneration
+    return TextGeneration()
+
+
+def load_txt2speech():
+    from src.module.txt2speech import Txt2Speech
+    return Txt2Speech()
+
+
 class SpeechSystem:
     def __init__(self, inp: InputSpeechSystemModel):
         global TEXT_GENERATION_INIT, EMOTION_ANALYSIS_INIT, TXT_TO_SPEECH_INIT
 
         self.input_audio_file_path = inp.input_audio_file_path
+        cold_start = EMOTION_ANALYSIS_INIT is None
+        start_time = time.time()
 
         with ThreadPoolExecutor() as executor:
             # future_text_generation = executor.submit(
-            #     lambda: TEXT_GENERATION_INIT or TextGeneration()
+            #     lambda: TEXT_GENERATION_INIT or load_text_generation()
             # )
 
             future_emotion_analysis = executor.submit(
@@ -32,7 +47,7 @@ class SpeechSystem:
             )
 
             # future_text_to_speech = executor.submit(
-            #     lambda: TXT_TO_SPEECH_INIT or Txt2Speech()
+            #     lambda: TXT_TO_SPEECH_INIT or load_txt2speech()
             # )
 
             future_speech_to_text = executor.submit(
@@ -49,6 +64,8 @@ class SpeechSystem:
         self.text_generation = TEXT_GENERATION_INIT
         self.text_to_speech = TXT_TO_SPEECH_INIT
 
+        if cold_start:
+            log_resource_usage(f'Speech system cold start took {time.time() - start_time:.2f}s')
 
 
     def run(self) -> OutputSpeechSystemModel:
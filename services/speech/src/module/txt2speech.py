@@ -1,11 +1,28 @@
+import os
 import logging
+import hashlib
 import torch
 import time
 
 from TTS.api import TTS
 
+from src.utils.common import make_directory
 from src.config.app_config import Txt2SpeechConfig as tc
 
+
+# Reference encoding settings used by Xtts.full_inference, which is what
+# tts_to_file(speaker_wav=...) runs; the cached conditioning must match them.
+CONDITIONING_SETTINGS = {
+    'gpt_cond_len': 30,
+    'gpt_cond_chunk_len': 6,
+    'max_ref_length': 10,
+    'sound_norm_refs': False,
+}
+
+# Silence the synthesizer inserts after every sentence.
+SENTENCE_PAUSE_SAMPLES = 10000
+
+
 class Txt2Speech:
     def __init__(self):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -18,9 +35,83 @@ class Txt2Speech:
         self.model = TTS(model_path=self.model_cache, config_path=self.model_config).to(self.device)
         logging.info('Loading Text to Speech model ...')
 
+        # Voice-cloning models such as XTTS can synthesize from precomputed
+        # speaker conditioning instead of re-encoding the reference WAV.
+        self.tts_model = self.model.synthesizer.tts_model
+        self.conditioning_cache_dir = tc.conditioning_cache_dir
+        self.conditioning = {}
+        if hasattr(self.tts_model, 'get_conditioning_latents'):
+            self.load_speaker_conditioning()
+
         logging.info('Initialize Text to Speech parameters ...')
 
 
+    def conditioning_path(self, ref_audio):
+        """Cache file for a reference, keyed by the model, the encoding settings and the WAV content."""
+        digest = hashlib.sha256(f'{self.model_cache}|{sorted(CONDITIONING_SETTINGS.items())}'.encode('utf-8'))
+        with open(ref_audio, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return os.path.join(self.conditioning_cache_dir, f'{digest.hexdigest()[:16]}.pt')
+
+
+    def load_speaker_conditioning(self):
+        """Computes the conditioning latents and speaker embedding of every reference once.
+
+        Results are persisted, so later starts only load a few small tensors;
+        editing a reference file changes its hash and recomputes it.
+        """
+        make_directory(self.conditioning_cache_dir)
+        start_time = time.time()
+
+        ref_audios = {tc.ref_audio_neutral, tc.ref_audio_sad, tc.ref_audio_happy,
+                      tc.ref_audio_sympathy, tc.ref_audio_surprise}
+        for ref_audio in ref_audios:
+            path = self.conditioning_path(ref_audio)
+            if os.path.exists(path):
+                conditioning = torch.load(path, map_location=self.device, weights_only=True)
+            else:
+                gpt_cond_latent, speaker_embedding = self.tts_model.get_conditioning_latents(
+                    audio_path=[ref_audio], **CONDITIONING_SETTINGS)
+                conditioning = {'gpt_cond_latent': gpt_cond_latent, 'speaker_embedding': speaker_embedding}
+                torch.save(conditioning, path)
+                logging.info(f'Saved speaker conditioning of {ref_audio} to {path}')
+            self.conditioning[ref_audio] = conditioning
+
+        logging.info(f'Loaded speaker conditioning for {len(self.conditioning)} references in {time.time() - start_time}s')
+
+
+    def synthesize(self, input_text, ref_audio):
+        """Waveform for the text in the reference voice, from cached conditioning when available.
+
+        Mirrors Synthesizer.tts with Xtts.synthesize: the text is split into
+        sentences, each is sampled with the model config's settings, and the
+        sentences are joined with the same pause.
+        """
+        conditioning = self.conditioning.get(ref_audio)
+        if conditioning is None:
+            return self.model.tts(text=input_text, speaker_wav=ref_audio, language=self.language)
+
+        config = self.tts_model.config
+        wav = []
+        for sentence in self.model.synthesizer.split_into_sentences(input_text):
+            output = self.tts_model.inference(sentence,
+                                              self.language,
+                                              conditioning['gpt_cond_latent'],
+                                              conditioning['speaker_embedding'],
+                                              temperature=config.temperature,
+                                              length_penalty=config.length_penalty,
+                                              repetition_penalty=config.repetition_penalty,
+                                              top_k=config.top_k,
+                                              top_p=config.top_p)
+            sentence_wav = output['wav']
+            if torch.is_tensor(sentence_wav):
+                sentence_wav = sentence_wav.cpu().numpy()
+            wav.extend(sentence_wav.squeeze().tolist())
+            wav.extend([0] * SENTENCE_PAUSE_SAMPLES)
+        return wav
+
+
     def mapping_emotion_analysis(self, emotion):
         logging.info('Start mapping emotion with reference audio')
         if emotion == 'neutral':
@@ -40,12 +131,40 @@ class Txt2Speech:
         ref_audio = self.mapping_emotion_analysis(emotion)
 
         start_time = time.time()
-        self.model.tts_to_file(text=input_text, 
-                               speaker_wav=ref_audio, 
-                               language=self.language, 
-                               file_path=self.output_file_path)
+        wav = self.synthesize(input_text, ref_audio)
+        self.model.synthesizer.save_wav(wav=wav, path=self.output_file_path)
         end_time = time.time()
 
         logging.info(f'Finish Text to Speech process saved in {self.output_file_path} in {end_time-start_time}s')
 
         return self.output_file_path
+
+
+    def run_stream(self, sentences, emotion, on_audio=None):
+        """Synthesizes sentences as they arrive, e.g. from TextGeneration.stream.
+
+        Each sentence is passed to on_audio as soon as its audio is ready, so
+        playback can start while the rest is still being generated; the full
+        response is saved to output_file_path at the end.
+        """
+        logging.info('Start streaming text to speech ...')
+
+        ref_audio = self.mapping_emotion_analysis(emotion)
+
+        start_time = time.time()
+        audio = []
+        for sentence in sentences:
+            wav = self.synthesize(sentence, ref_audio)
+            if not audio:
+                logging.info(f'Time to first audio: {time.time() - start_time}s')
+            audio.extend(wav)
+            if on_audio is not None:
+                on_audio(wav)
+
+        if not audio:
+            return None
+
+        self.model.synthesizer.save_wav(wav=audio, path=self.output_file_path)
+        logging.info(f'Finish streaming Text to Speech process saved in {self.output_file_path} in {time.time() - start_time}s')
+
+        return self.output_file_path
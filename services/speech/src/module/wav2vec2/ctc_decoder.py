@@ -0,0 +1,213 @@
+import gzip
+import math
+import logging
+import numpy as np
+
+from collections import defaultdict
+
+from src.config.app_config import Speech2TxtConfig as sc
+
+NEG_INF = -float('inf')
+LOG10_TO_LN = math.log(10)
+
+
+def log_softmax(logits):
+    logits = np.asarray(logits, dtype=np.float32)
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+
+class NGramLanguageModel:
+    """Word-level back-off n-gram model loaded from an ARPA file (optionally gzipped)."""
+    def __init__(self, lm_path):
+        self.lm_path = lm_path
+        self.ngrams = {}
+        self.order = 0
+
+        opener = gzip.open if str(lm_path).endswith('.gz') else open
+        with opener(lm_path, 'rt', encoding='utf-8') as file:
+            self.load_arpa(file)
+
+        self.unk_logprob = self.ngrams.get(('<unk>',), (-100.0, 0.0))[0]
+        logging.info(f'Loaded {self.order}-gram language model with {len(self.ngrams)} entries from {lm_path}')
+
+
+    def load_arpa(self, file):
+        current_order = 0
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('\\data\\') or line.startswith('ngram '):
+                continue
+            if line == '\\end\\':
+                break
+            if line.startswith('\\') and line.endswith('-grams:'):
+                current_order = int(line[1:line.index('-')])
+                self.order = max(self.order, current_order)
+                continue
+
+            parts = line.split()
+            logprob = float(parts[0])
+            words = tuple(word.lower() for word in parts[1:1 + current_order])
+            backoff = float(parts[1 + current_order]) if len(parts) > 1 + current_order else 0.0
+            self.ngrams[words] = (logprob, backoff)
+
+
+    def score(self, history, word):
+        """Natural-log probability of word given the history, using Katz back-off."""
+        history = tuple(history)[-(self.order - 1):] if self.order > 1 else ()
+        backoff = 0.0
+
+        while True:
+            entry = self.ngrams.get(history + (word,))
+            if entry is not None:
+                return (entry[0] + backoff) * LOG10_TO_LN
+            if not history:
+                return (self.unk_logprob + backoff) * LOG10_TO_LN
+
+            backoff += self.ngrams.get(history, (0.0, 0.0))[1]
+            history = history[1:]
+
+
+class CTCDecoder:
+    """Greedy and prefix beam search decoding directly on wav2vec2 CTC logits."""
+    def __init__(self, tokenizer):
+        self.blank_id = tokenizer.pad_token_id
+        self.word_delimiter = tokenizer.word_delimiter_token
+        special_tokens = set(tokenizer.all_special_tokens)
+
+        vocab = tokenizer.get_vocab()
+        tokens = [''] * (max(vocab.values()) + 1)
+        for token, token_id in vocab.items():
+            if token == self.word_delimiter:
+                tokens[token_id] = ' '
+            elif token not in special_tokens:
+                tokens[token_id] = token
+        self.tokens = np.array(tokens, dtype=object)
+
+        self.decoder_type = sc.ctc_decoder
+        self.beam_width = sc.beam_width
+        self.blank_threshold = math.log(sc.beam_blank_threshold)
+        self.token_min_logp = sc.beam_token_min_logp
+        self.lm_alpha = sc.lm_alpha
+        self.lm_beta = sc.lm_beta
+
+        self.lm = NGramLanguageModel(sc.lm_path) if sc.lm_path else None
+
+        if self.decoder_type not in ['greedy', 'beam']:
+            raise ValueError(f'Unknown CTC decoder type: {self.decoder_type}')
+        logging.info(f'Initialized {self.decoder_type} CTC decoder')
+
+
+    def greedy_decode(self, logits):
+        """Collapses repeats and blanks in one vectorized pass.
+
+        Returns the text together with the probability of every emitted token.
+        """
+        log_probs = log_softmax(logits)
+        ids = log_probs.argmax(axis=-1)
+
+        keep = np.ones(len(ids), dtype=bool)
+        keep[1:] = ids[1:] != ids[:-1]
+        keep &= ids != self.blank_id
+
+        kept_ids = ids[keep]
+        text = ' '.join(''.join(self.tokens[kept_ids]).split())
+        token_probs = np.exp(log_probs[keep, kept_ids])
+
+        return text, token_probs
+
+
+    def word_score(self, prefix):
+        """LM contribution for the last complete word of prefix."""
+        words = prefix.lower().split()
+        if not words:
+            return 0.0
+        return self.lm_alpha * self.lm.score(words[:-1], words[-1]) + self.lm_beta
+
+
+    def beam_search(self, logits):
+        """CTC prefix beam search with optional n-gram shallow fusion.
+
+        Frames whose blank probability exceeds beam_blank_threshold only extend
+        every prefix with blank, and per-frame candidates below
+        beam_token_min_logp are pruned before the beam is expanded.
+        """
+        log_probs = log_softmax(logits)
+
+        # prefix -> (log p ending in blank, log p ending in non-blank)
+        beams = {'': (0.0, NEG_INF)}
+        lm_scores = {'': 0.0}
+
+        for frame in log_probs:
+            blank_logp = frame[self.blank_id]
+            if blank_logp > self.blank_threshold:
+                beams = {prefix: (np.logaddexp(p_b, p_nb) + blank_logp, NEG_INF)
+                         for prefix, (p_b, p_nb) in beams.items()}
+                continue
+
+            candidates = np.flatnonzero(frame >= self.token_min_logp)
+            next_beams = defaultdict(lambda: [NEG_INF, NEG_INF])
+
+            for prefix, (p_b, p_nb) in beams.items():
+                total = np.logaddexp(p_b, p_nb)
+                next_beams[prefix][0] = np.logaddexp(next_beams[prefix][0], total + blank_logp)
+
+                for token_id in candidates:
+                    if token_id == self.blank_id:
+                        continue
+
+                    char = self.tokens[token_id]
+                    logp = frame[token_id]
+
+                    # Special tokens and leading/double word delimiters behave like blank.
+                    if not char or (char == ' ' and (not prefix or prefix[-1] == ' ')):
+                        next_beams[prefix][0] = np.logaddexp(next_beams[prefix][0], total + logp)
+                        continue
+
+                    new_prefix = prefix + char
+                    if new_prefix not in lm_scores:
+                        lm_scores[new_prefix] = lm_scores[prefix]
+                        if char == ' ' and self.lm is not None:
+                            lm_scores[new_prefix] += self.word_score(prefix)
+
+                    if prefix and char == prefix[-1]:
+                        # A repeat only starts a new token after a blank.
+                        next_beams[prefix][1] = np.logaddexp(next_beams[prefix][1], p_nb + logp)
+                        next_beams[new_prefix][1] = np.logaddexp(next_beams[new_prefix][1], p_b + logp)
+                    else:
+                        next_beams[new_prefix][1] = np.logaddexp(next_beams[new_prefix][1], total + logp)
+
+            ranked = sorted(next_beams.items(),
+                            key=lambda item: np.logaddexp(*item[1]) + lm_scores[item[0]],
+                            reverse=True)
+            beams = {prefix: tuple(scores) for prefix, scores in ranked[:self.beam_width]}
+
+        def final_score(prefix):
+            score = np.logaddexp(*beams[prefix]) + lm_scores[prefix]
+            if self.lm is not None and prefix and prefix[-1] != ' ':
+                score += self.word_score(prefix)
+            return score
+
+        best = max(beams, key=final_score)
+        return ' '.join(best.split())
+
+
+    def decode(self, logits):
+        return self.decode_with_confidence(logits)[0]
+
+
+    def decode_with_confidence(self, logits):
+        """Returns the text, the per-token probabilities and a segment confidence.
+
+        Token probabilities always come from the greedy path; the segment
+        confidence is their geometric mean, or 0.0 when nothing was emitted.
+        """
+        text, token_probs = self.greedy_decode(logits)
+        if self.decoder_type == 'beam':
+            text = self.beam_search(logits)
+
+        if len(token_probs) == 0:
+            return text, token_probs, 0.0
+
+        confidence = float(np.exp(np.log(np.maximum(token_probs, 1e-10)).mean()))
+        return text, token_probs, confidence
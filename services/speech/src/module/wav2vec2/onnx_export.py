@@ -0,0 +1,190 @@
+import hashlib
+import logging
+import time
+import uuid
+import wave
+import numpy as np
+
+from transformers import Wav2Vec2Processor
+
+from src.utils.common import *
+from src.utils.onnx_session import OnnxSession
+from src.config.app_config import Speech2TxtConfig as sc
+
+
+def logits_only(model):
+    """Wraps the model so the exported graph has the CTC logits as its single output."""
+    import torch
+
+    class LogitsOnlyWrapper(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_values, attention_mask=None):
+            return self.model(input_values, attention_mask=attention_mask).logits
+
+    return LogitsOnlyWrapper(model).eval()
+
+
+def temporary_path(path):
+    """Sibling path to write to before os.replace; the suffix keeps it out of *.onnx searches."""
+    return f'{path}.{uuid.uuid4().hex}.tmp'
+
+
+class Wav2vec2OnnxExporter:
+    """Exports wav2vec2 to ONNX once and caches the artifact under a key of its export options.
+
+    torch is only imported when an export is actually needed, so workers that
+    find a cached artifact never load it.
+    """
+    def __init__(self):
+        self.model_name = sc.model_name
+        self.model_revision = sc.model_revision
+        self.model_cache = sc.model_cache
+        self.sampling_rate = sc.sampling_rate
+        self.opset = sc.onnx_opset
+        self.quantize = sc.onnx_quantize
+        self.report_audio = sc.onnx_report_audio
+        self.report_runs = sc.onnx_report_runs
+
+        self.artifact_dir = os.path.join(self.model_cache, 'onnx', self.artifact_key(self.quantize))
+        self.artifact_path = os.path.join(self.artifact_dir, 'model.onnx')
+        self.report_path = os.path.join(self.artifact_dir, 'report.json')
+
+
+    def artifact_key(self, quantize):
+        precision = 'int8' if quantize else 'fp32'
+        options = f'{self.model_name}@{self.model_revision}|opset={self.opset}|{precision}'
+        digest = hashlib.sha256(options.encode('utf-8')).hexdigest()[:12]
+        return f"{self.model_name.replace('/', '--')}-{self.model_revision}-{precision}-{digest}"
+
+
+    def export(self, model, use_attention_mask, output_path):
+        import torch
+
+        make_directory(os.path.dirname(output_path))
+
+        dummy_input = torch.zeros(1, self.sampling_rate)
+        input_names = ['input_values']
+        dynamic_axes = {'input_values': {0: 'batch', 1: 'samples'},
+                        'logits': {0: 'batch', 1: 'frames'}}
+        args = (dummy_input,)
+
+        if use_attention_mask:
+            args = (dummy_input, torch.ones(1, self.sampling_rate, dtype=torch.int64))
+            input_names.append('attention_mask')
+            dynamic_axes['attention_mask'] = {0: 'batch', 1: 'samples'}
+
+        start_time = time.time()
+        temp_path = temporary_path(output_path)
+        torch.onnx.export(
+            logits_only(model),
+            args,
+            temp_path,
+            input_names=input_names,
+            output_names=['logits'],
+            dynamic_axes=dynamic_axes,
+            opset_version=self.opset,
+            do_constant_folding=True)
+        os.replace(temp_path, output_path)
+        logging.info(f'Exported wav2vec2 to {output_path} in {time.time() - start_time}s')
+
+
+    def load_report_audio(self):
+        if self.report_audio and os.path.exists(self.report_audio):
+            with wave.open(self.report_audio, 'rb') as wf:
+                audio = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+            return audio.astype(np.float32) / 32767
+
+        logging.warning('No sample audio for the ONNX export report, falling back to synthetic noise.')
+        return np.random.default_rng(0).standard_normal(self.sampling_rate * 5).astype(np.float32) * 0.1
+
+
+    def build_report(self, model, processor, onnx_path):
+        """Compares the exported model against the HF model on sample audio."""
+        import torch
+
+        audio = self.load_report_audio()
+        input_values = processor(audio, sampling_rate=self.sampling_rate, return_tensors='np').input_values
+        input_values = input_values.astype(np.float32)
+
+        session = OnnxSession(onnx_path)
+        onnx_inputs = {'input_values': input_values,
+                       'attention_mask': np.ones(input_values.shape, dtype=np.int64)}
+
+        hf_latencies, onnx_latencies = [], []
+        for _ in range(self.report_runs):
+            start_time = time.time()
+            with torch.no_grad():
+                hf_logits = model(torch.from_numpy(input_values)).logits.numpy()
+            hf_latencies.append(time.time() - start_time)
+
+            start_time = time.time()
+            onnx_logits = session.run(onnx_inputs)[0]
+            onnx_latencies.append(time.time() - start_time)
+
+        hf_ids = hf_logits.argmax(axis=-1)
+        onnx_ids = onnx_logits.argmax(axis=-1)
+
+        report = {
+            'artifact': str(onnx_path),
+            'quantized': self.quantize,
+            'audio_seconds': len(audio) / self.sampling_rate,
+            'max_abs_logit_diff': float(np.abs(hf_logits - onnx_logits).max()),
+            'argmax_agreement': float((hf_ids == onnx_ids).mean()),
+            'hf_transcript': processor.batch_decode(hf_ids)[0],
+            'onnx_transcript': processor.batch_decode(onnx_ids)[0],
+            'hf_latency_seconds': float(np.median(hf_latencies)),
+            'onnx_latency_seconds': float(np.median(onnx_latencies)),
+        }
+        report['transcripts_match'] = report['hf_transcript'] == report['onnx_transcript']
+        report['speedup'] = report['hf_latency_seconds'] / max(report['onnx_latency_seconds'], 1e-9)
+        return report
+
+
+    def get_or_create(self):
+        """Returns the cached ONNX artifact path, exporting (and quantizing) it on first use.
+
+        Artifacts are written to a temporary file and moved into place with
+        os.replace, so a crashed or concurrent export never leaves a truncated
+        model.onnx that later starts would reuse.
+        """
+        if os.path.exists(self.artifact_path):
+            logging.info(f'Reusing cached ONNX artifact {self.artifact_path}')
+            return self.artifact_path
+
+        logging.info('No cached ONNX artifact found, exporting wav2vec2 ...')
+        from transformers import Wav2Vec2ForCTC
+
+        model = Wav2Vec2ForCTC.from_pretrained(
+            pretrained_model_name_or_path=self.model_name,
+            revision=self.model_revision,
+            cache_dir=self.model_cache).eval()
+        processor = Wav2Vec2Processor.from_pretrained(
+            pretrained_model_name_or_path=self.model_name,
+            revision=self.model_revision,
+            cache_dir=self.model_cache)
+        use_attention_mask = processor.feature_extractor.return_attention_mask
+
+        fp32_path = os.path.join(self.model_cache, 'onnx', self.artifact_key(False), 'model.onnx')
+        if not os.path.exists(fp32_path):
+            self.export(model, use_attention_mask, fp32_path)
+
+        if self.quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            make_directory(self.artifact_dir)
+            start_time = time.time()
+            temp_path = temporary_path(self.artifact_path)
+            quantize_dynamic(model_input=fp32_path,
+                             model_output=temp_path,
+                             weight_type=QuantType.QInt8)
+            os.replace(temp_path, self.artifact_path)
+            logging.info(f'Quantized ONNX model to int8 in {time.time() - start_time}s')
+
+        report = self.build_report(model, processor, self.artifact_path)
+        save_json(report, self.report_path)
+        logging.info(f'ONNX export report: {report}')
+
+        return self.artifact_path
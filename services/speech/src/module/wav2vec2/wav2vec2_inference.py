@@ -1,35 +1,61 @@
-import torch
 import logging
 import numpy as np
-import onnxruntime as ort
 
-from transformers import Wav2Vec2ForCTC, Wav2Vec2Processor
+from queue import Queue
+
+from transformers import Wav2Vec2Config, Wav2Vec2Processor
 
 from src.utils.common import *
+from src.utils.onnx_session import OnnxSession
 from src.config.app_config import Speech2TxtConfig as sc
+from src.module.wav2vec2.ctc_decoder import CTCDecoder
+from src.module.wav2vec2.onnx_export import Wav2vec2OnnxExporter
 
 class Wav2vec2Inference:
     def __init__(self):
         self.model_name = sc.model_name
+        self.model_revision = sc.model_revision
         self.model_cache = sc.model_cache
         self.sampling_rate = sc.sampling_rate
         self.return_tensors = sc.return_tensors
         self.padding = sc.padding
+        self.batch_size = sc.batch_size
+        self.chunk_samples = int(sc.chunk_length_seconds * sc.sampling_rate)
+        self.stride_left_samples = int(sc.stride_left_seconds * sc.sampling_rate)
+        self.stride_right_samples = int(sc.stride_right_seconds * sc.sampling_rate)
+
+        if self.chunk_samples <= self.stride_left_samples + self.stride_right_samples:
+            raise ValueError('chunk_length_seconds must be larger than the sum of the left and right strides')
 
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # Concurrent Run() calls on one ONNX session share its intra-op pool, so
+        # every ASR worker gets its own session with an equal share of the cores.
+        self.num_threads = max(1, (os.cpu_count() or 1) // sc.asr_workers)
 
         if not os.path.exists(sc.model_cache):
             make_directory(sc.model_cache)
 
-        onnx_file = find_files(directory_path=sc.model_cache, type_file='onnx')
+        if sc.onnx_export:
+            onnx_file = [Wav2vec2OnnxExporter().get_or_create()]
+        else:
+            onnx_file = find_files(directory_path=sc.model_cache, type_file='onnx')
+
         if onnx_file:
             self.model_type = 'onnx'
-            self.model = ort.InferenceSession(onnx_file[0], providers=['CPUExecutionProvider'])
-            logging.info('Loaded ONNX model for the first time.')
+            self.sessions = Queue()
+            for _ in range(sc.asr_workers):
+                self.sessions.put(OnnxSession(onnx_file[0], intra_op_num_threads=self.num_threads))
+            logging.info(f'Loaded {sc.asr_workers} ONNX sessions with {self.num_threads} threads each.')
         else:
+            # torch is only needed for the Hugging Face fallback; the ONNX path
+            # runs on onnxruntime and numpy alone.
+            import torch
+            from transformers import Wav2Vec2ForCTC
+
             self.model_type = 'hf'
+            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
             self.model = Wav2Vec2ForCTC.from_pretrained(
                 pretrained_model_name_or_path=self.model_name,
+                revision=self.model_revision,
                 cache_dir=self.model_cache
             ).to(self.device)
             logging.info('Loaded pretrained Hugging Face model for the first time.')
@@ -41,36 +67,187 @@ class Wav2vec2Inference:
             logging.info('Warming up model ...')
 
         self.processor = Wav2Vec2Processor.from_pretrained(
-            pretrained_model_name_or_path=sc.model_name, 
+            pretrained_model_name_or_path=sc.model_name,
+            revision=sc.model_revision,
             cache_dir=sc.model_cache)
 
         logging.info('Loading pretrained processor ...')
 
+        self.decoder = CTCDecoder(self.processor.tokenizer)
 
-    def speech_recognition(self, audio_buffer):
+        self.config = Wav2Vec2Config.from_pretrained(
+            pretrained_model_name_or_path=sc.model_name,
+            revision=sc.model_revision,
+            cache_dir=sc.model_cache)
+
+        # Models trained without attention masks (e.g. wav2vec2-base) expect
+        # zero padding only, so the mask is forwarded only when supported.
+        self.use_attention_mask = self.processor.feature_extractor.return_attention_mask
+        self.do_normalize = self.processor.feature_extractor.do_normalize
+        self.padding_value = self.processor.feature_extractor.padding_value
+        self.inputs_to_logits_ratio = int(np.prod(self.config.conv_stride))
+
+
+    def logits_lengths(self, input_lengths):
+        """Number of logit frames the conv feature encoder emits per input length."""
+        lengths = np.asarray(input_lengths, dtype=np.int64)
+        for kernel_size, stride in zip(self.config.conv_kernel, self.config.conv_stride):
+            lengths = (lengths - kernel_size) // stride + 1
+        return np.maximum(lengths, 0)
+
+
+    def forward(self, input_values, attention_mask=None):
+        """Runs one padded batch through the acoustic model and returns numpy logits."""
         if self.model_type == 'hf':
-            if len(audio_buffer) == 0:
-                return ""
+            import torch
 
-            inputs = self.processor(torch.tensor(audio_buffer), 
-                                    sampling_rate=self.sampling_rate, 
-                                    return_tensors=self.return_tensors, 
-                                    padding=self.padding).input_values
+            inputs = {'input_values': torch.from_numpy(input_values).to(self.device)}
+            if attention_mask is not None and self.use_attention_mask:
+                inputs['attention_mask'] = torch.from_numpy(attention_mask).to(self.device)
 
             with torch.no_grad():
-                logits = self.model(inputs.to(self.device)).logits            
-
-            predicted_ids = torch.argmax(logits, dim=-1)
-            generated_text = self.processor.batch_decode(predicted_ids)[0]
+                logits = self.model(**inputs).logits
+            return logits.cpu().numpy()
 
-        
         elif self.model_type == 'onnx':
-            input_values = self.processor(audio_buffer, sampling_rate=self.sampling_rate, return_tensors='np').input_values
-            onnx_inputs = {"input_values": input_values}
-            logging.info('Loading and pre-processing onnx input values ...')
+            onnx_inputs = {'input_values': input_values}
+            if attention_mask is not None:
+                onnx_inputs['attention_mask'] = attention_mask
+
+            batch_size, num_samples = input_values.shape
+            frames = int(self.logits_lengths([num_samples])[0])
+            output_shapes = {'logits': (batch_size, frames, self.config.vocab_size)}
+            session = self.sessions.get()
+            try:
+                return session.run(onnx_inputs, output_shapes=output_shapes)[0]
+            finally:
+                self.sessions.put(session)
+
+
+    def decode(self, logits):
+        """Decodes one segment into its text with per-token and per-segment confidence."""
+        text, token_confidences, confidence = self.decoder.decode_with_confidence(logits)
+        return {'text': text, 'confidence': confidence, 'token_confidences': token_confidences}
+
+
+    def normalize_into(self, audio_buffer, out):
+        """Writes one segment into a float32 model-input row in a single pass.
+
+        int16 PCM is scaled to [-1, 1] and, when the feature extractor normalizes,
+        shifted to zero mean and unit variance with the same epsilon it uses.
+        """
+        scale = 1 / 32767 if np.issubdtype(audio_buffer.dtype, np.integer) else 1.0
+        np.copyto(out, audio_buffer, casting='unsafe')
+
+        if self.do_normalize:
+            mean = out.mean(dtype=np.float64)
+            variance = out.var(dtype=np.float64) * scale * scale
+            out -= mean
+            out *= scale / np.sqrt(variance + 1e-7)
+        elif scale != 1.0:
+            out *= scale
+
+
+    def prepare_inputs(self, audio_buffers):
+        lengths = np.array([len(audio) for audio in audio_buffers], dtype=np.int64)
+        max_length = int(lengths.max())
+
+        input_values = np.full((len(audio_buffers), max_length), self.padding_value, dtype=np.float32)
+        for row, audio in zip(input_values, audio_buffers):
+            self.normalize_into(np.asarray(audio), row[:len(audio)])
+
+        attention_mask = (np.arange(max_length)[None, :] < lengths[:, None]).astype(np.int64)
+        return input_values, attention_mask, lengths
+
 
-            logits = self.model.run(None, onnx_inputs)[0]
-            predicted_ids = np.argmax(logits, axis=-1)
-            generated_text = self.processor.batch_decode(predicted_ids)[0]
+    def batch_logits(self, audio_buffers):
+        """Pads a bucket of segments into one forward pass and returns the unpadded logits of each."""
+        input_values, attention_mask, lengths = self.prepare_inputs(audio_buffers)
+
+        logits = self.forward(input_values, attention_mask)
+        frames = self.logits_lengths(lengths)
+
+        return [logits[i, :frames[i]] for i in range(len(audio_buffers))]
+
+
+    def chunk_windows(self, num_samples):
+        """Yields (start, end, left_stride, right_stride) windows covering num_samples."""
+        step = self.chunk_samples - self.stride_left_samples - self.stride_right_samples
+
+        for start in range(0, num_samples, step):
+            end = min(start + self.chunk_samples, num_samples)
+            left = self.stride_left_samples if start > 0 else 0
+            right = self.stride_right_samples if end < num_samples else 0
+            yield start, end, left, right
+
+            if end >= num_samples:
+                break
+
+
+    def chunked_logits(self, audio_buffer):
+        """Runs fixed-size overlapping windows and stitches their CTC logits.
+
+        Each window drops the logit frames that fall inside its left and right
+        strides, so the kept regions tile the segment exactly once. Windows are
+        forwarded at most batch_size at a time, which bounds peak memory
+        regardless of the segment length.
+        """
+        windows = list(self.chunk_windows(len(audio_buffer)))
+        pieces = []
+
+        for i in range(0, len(windows), self.batch_size):
+            group = windows[i:i + self.batch_size]
+            logits = self.batch_logits([audio_buffer[start:end] for start, end, _, _ in group])
+
+            for (_, _, left, right), window_logits in zip(group, logits):
+                left_frames = int(round(left / self.inputs_to_logits_ratio))
+                right_frames = int(round(right / self.inputs_to_logits_ratio))
+                # Copy out of the reusable output buffer before the next group overwrites it.
+                pieces.append(np.array(window_logits[left_frames:len(window_logits) - right_frames]))
+
+        logging.info(f'Stitched {len(windows)} windows for a segment of {len(audio_buffer)} samples')
+        return np.concatenate(pieces, axis=0)
+
+
+    def recognize_bucket(self, audio_buffers):
+        """Decodes a bucket of similar-length segments with one forward pass."""
+        return [self.decode(logits) for logits in self.batch_logits(audio_buffers)]
+
+
+    def speech_recognition_batch(self, audio_buffers, batch_size=None, return_confidence=False):
+        """Transcribes many segments, bucketed by length, and returns texts in input order.
+
+        With return_confidence the results are dicts holding the text, the
+        segment confidence and the per-token confidences instead.
+        """
+        batch_size = batch_size or self.batch_size
+        empty = {'text': "", 'confidence': 0.0, 'token_confidences': np.zeros(0, dtype=np.float32)}
+        results = [empty] * len(audio_buffers)
+
+        # Segments longer than one window go through the bounded-memory chunked path.
+        for i, audio in enumerate(audio_buffers):
+            if len(audio) > self.chunk_samples:
+                results[i] = self.decode(self.chunked_logits(audio))
+
+        # Sorting by length keeps padding inside each bucket small.
+        order = sorted(
+            (i for i, audio in enumerate(audio_buffers) if 0 < len(audio) <= self.chunk_samples),
+            key=lambda i: len(audio_buffers[i]))
+
+        for start in range(0, len(order), batch_size):
+            bucket = order[start:start + batch_size]
+            texts = self.recognize_bucket([audio_buffers[i] for i in bucket])
+            for i, text in zip(bucket, texts):
+                results[i] = text
+
+        logging.info(f'Recognized {len(order)} segments in {-(-len(order) // batch_size)} batches')
+        if return_confidence:
+            return results
+        return [result['text'] for result in results]
+
+
+    def speech_recognition(self, audio_buffer):
+        if len(audio_buffer) == 0:
+            return ""
 
-        return generated_text
+        return self.speech_recognition_batch([audio_buffer])[0]
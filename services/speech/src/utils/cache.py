@@ -0,0 +1,216 @@
+import os
+import time
+import redis
+import sqlite3
+import logging
+import threading
+
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """Cache key normalization: lowercase with collapsed whitespace."""
+    return ' '.join(text.lower().split())
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache bounded by entry count and by byte size.
+
+    With ttl_seconds, entries older than that are treated as misses and dropped.
+    """
+    def __init__(self, max_entries, max_bytes, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def entry_size(key, value):
+        return len(key.encode('utf-8')) + len(value.encode('utf-8'))
+
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl_seconds and time.time() - entry[1] > self.ttl_seconds:
+                self.size_bytes -= self.entry_size(key, self.entries.pop(key)[0])
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+
+    def put(self, key, value):
+        size = self.entry_size(key, value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size_bytes -= self.entry_size(key, self.entries.pop(key)[0])
+
+            self.entries[key] = (value, time.time())
+            self.size_bytes += size
+
+            while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                old_key, (old_value, _) = self.entries.popitem(last=False)
+                self.size_bytes -= self.entry_size(old_key, old_value)
+
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+
+class DiskCache:
+    """SQLite-backed key/value tier that survives worker restarts.
+
+    The least recently used rows are pruned once the table grows past
+    max_entries. Access times of hits are buffered and written in one
+    transaction with the next put or every TOUCH_BATCH hits, so lookups do
+    not commit.
+    """
+    TOUCH_BATCH = 256
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.touched = {}
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self.connection.commit()
+        logging.info(f'Opened disk cache {path}')
+
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.touched[key] = time.time()
+            if len(self.touched) >= self.TOUCH_BATCH:
+                self.flush_touched()
+                self.connection.commit()
+            self.hits += 1
+            return row[0]
+
+
+    def flush_touched(self):
+        """Writes the buffered access times; the caller holds the lock and commits."""
+        if self.touched:
+            self.connection.executemany('UPDATE cache SET accessed = ? WHERE key = ?',
+                                        [(accessed, key) for key, accessed in self.touched.items()])
+            self.touched = {}
+
+
+    def put(self, key, value):
+        with self.lock:
+            self.flush_touched()
+            self.connection.execute('INSERT OR REPLACE INTO cache (key, value, accessed) VALUES (?, ?, ?)',
+                                    (key, value, time.time()))
+            self.writes += 1
+
+            # Pruning is amortized over many writes instead of counting rows every time.
+            if self.writes % 256 == 0:
+                self.connection.execute(
+                    'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,))
+            self.connection.commit()
+
+
+class RedisCache:
+    """Redis tier shared by all workers.
+
+    Entries expire after ttl_seconds and values above max_value_bytes are not
+    stored; overall size is left to the server's maxmemory policy. Redis
+    errors are logged and treated as misses so a cache outage never fails a
+    request.
+    """
+    def __init__(self, url, prefix, ttl_seconds, max_value_bytes):
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+        self.max_value_bytes = max_value_bytes
+        self.hits = 0
+        self.misses = 0
+        self.client = redis.Redis.from_url(url, socket_timeout=1.0)
+        logging.info(f'Using redis cache with prefix {prefix}')
+
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except redis.RedisError as e:
+            logging.warning(f'Redis cache get failed: {e}')
+            value = None
+
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value.decode('utf-8')
+
+
+    def put(self, key, value):
+        if len(value.encode('utf-8')) > self.max_value_bytes:
+            return
+        try:
+            self.client.set(self.prefix + key, value, ex=self.ttl_seconds)
+        except redis.RedisError as e:
+            logging.warning(f'Redis cache put failed: {e}')
+
+
+class TieredCache:
+    """Memory LRU in front of an optional shared or persistent tier; its hits are promoted to memory."""
+    def __init__(self, memory, backing=None):
+        self.memory = memory
+        self.backing = backing
+
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.backing is not None:
+            value = self.backing.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return value
+
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.backing is not None:
+            self.backing.put(key, value)
+
+
+    def stats(self):
+        stats = {'memory': self.memory.stats()}
+        if self.backing is not None:
+            stats['backing'] = {'hits': self.backing.hits, 'misses': self.backing.misses}
+        return stats
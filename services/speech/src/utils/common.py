@@ -1,17 +1,26 @@
 import yaml
 import os
-import torch
+import sys
 import json
+import resource
 from pathlib import Path
 import logging
 
 def warm_up_model(device, model):
+    import torch
+
     dummy_input = torch.zeros(1, 16000).to(device) 
     for _ in range(3):  
         with torch.no_grad():
             _ = model(dummy_input).logits
 
 
+def log_resource_usage(label):
+    """Logs the peak resident memory of the process and whether torch has been imported."""
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    logging.info(f"{label}: peak RSS {peak_rss_mb:.1f} MB, torch loaded: {'torch' in sys.modules}")
+
+
 def read_yaml_file(file_path):
     try:
         with open(file_path, 'r') as file:
@@ -0,0 +1,62 @@
+import time
+import logging
+import threading
+
+from queue import Queue, Empty
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """Groups concurrent single-item calls into batched calls of batch_fn.
+
+    Callers block on submit() while a background thread flushes the queue as
+    one batch once max_batch_size items are waiting or the oldest item has
+    waited max_wait_seconds. batch_fn takes a list of items and returns one
+    result per item, in order.
+    """
+    def __init__(self, batch_fn, max_batch_size, max_wait_seconds, name='micro-batcher'):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.queue = Queue()
+
+        self.thread = threading.Thread(target=self.loop, name=name, daemon=True)
+        self.thread.start()
+
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future.result()
+
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait_seconds
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+
+    def loop(self):
+        while True:
+            batch = self.collect()
+            items = [item for item, _ in batch]
+
+            try:
+                results = self.batch_fn(items)
+            except Exception as e:
+                logging.error(f'Batched call failed for {len(items)} items: {e}')
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
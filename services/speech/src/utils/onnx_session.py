@@ -0,0 +1,168 @@
+import uuid
+import hashlib
+import logging
+import platform
+import threading
+import numpy as np
+import onnxruntime as ort
+
+from src.utils.common import *
+from src.config.app_config import OnnxRuntimeConfig as oc
+
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+ONNX_TYPES = {
+    'tensor(float)': np.float32,
+    'tensor(float16)': np.float16,
+    'tensor(double)': np.float64,
+    'tensor(int64)': np.int64,
+    'tensor(int32)': np.int32,
+    'tensor(bool)': np.bool_,
+}
+
+
+def cpu_signature():
+    """Machine type, CPU model and instruction-set flags of this host."""
+    lines = []
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith(('model name', 'flags', 'Features')):
+                    lines.append(line.strip())
+                elif not line.strip() and lines:
+                    break
+    return '|'.join([platform.machine(), platform.processor()] + lines)
+
+
+def resolve_providers(providers):
+    """Keeps the configured providers that this onnxruntime build supports, always ending with CPU."""
+    available = ort.get_available_providers()
+    chain = [provider for provider in providers if provider in available]
+    if 'CPUExecutionProvider' not in chain:
+        chain.append('CPUExecutionProvider')
+
+    skipped = [provider for provider in providers if provider not in available]
+    if skipped:
+        logging.info(f'Skipping unavailable ONNX Runtime providers: {skipped}')
+    return chain
+
+
+class OnnxSession:
+    """ONNX Runtime session with tuned options, cached metadata and IOBinding.
+
+    Graph optimization runs once per model, host CPU, provider and level; the
+    optimized graph is saved atomically under optimized_model_dir and later
+    sessions load it with optimizations disabled. Output buffers for run(..., output_shapes=...) are
+    preallocated per thread and only grow, so returned arrays stay valid only
+    until the next call on the same thread.
+    """
+    def __init__(self, model_path, providers=None, intra_op_num_threads=None):
+        self.model_path = str(model_path)
+        self.providers = resolve_providers(providers or oc.providers)
+        self.use_io_binding = oc.use_io_binding
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_num_threads or oc.intra_op_num_threads
+        options.inter_op_num_threads = oc.inter_op_num_threads
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL if oc.inter_op_num_threads > 1 \
+            else ort.ExecutionMode.ORT_SEQUENTIAL
+
+        session_path = self.model_path
+        optimized_path = self.optimized_model_path()
+        if optimized_path and os.path.exists(optimized_path):
+            session_path = optimized_path
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            logging.info(f'Loading cached optimized ONNX model {optimized_path}')
+        else:
+            options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[oc.graph_optimization_level]
+            if optimized_path:
+                make_directory(os.path.dirname(optimized_path))
+                # ORT writes the graph while building the session; a temp sibling keeps
+                # concurrent workers from loading a half-written file.
+                temp_path = f'{optimized_path}.{uuid.uuid4().hex}.tmp'
+                options.optimized_model_filepath = temp_path
+
+        self.session = ort.InferenceSession(session_path, sess_options=options, providers=self.providers)
+        if session_path == self.model_path and optimized_path and os.path.exists(temp_path):
+            os.replace(temp_path, optimized_path)
+
+        self.inputs = self.session.get_inputs()
+        self.outputs = self.session.get_outputs()
+        self.input_names = [input.name for input in self.inputs]
+        self.output_names = [output.name for output in self.outputs]
+        self.input_types = {input.name: ONNX_TYPES.get(input.type, np.float32) for input in self.inputs}
+        self.output_types = {output.name: ONNX_TYPES.get(output.type, np.float32) for output in self.outputs}
+
+        self.local = threading.local()
+        logging.info(f'Created ONNX session for {self.model_path} with providers {self.session.get_providers()}')
+
+
+    def optimized_model_path(self):
+        if not oc.optimized_model_dir or oc.graph_optimization_level == 'disable':
+            return None
+
+        # Size and mtime make a model replaced in place get a fresh optimized graph, and the
+        # CPU signature keeps hosts on the shared volume from loading hardware-specific ops.
+        stat = os.stat(self.model_path)
+        stem = os.path.splitext(os.path.basename(self.model_path))[0]
+        key = f'{os.path.abspath(self.model_path)}|{stat.st_size}|{stat.st_mtime_ns}|{cpu_signature()}'
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:12]
+        name = f'{stem}-{digest}-{oc.graph_optimization_level}-{self.providers[0]}.ort.onnx'
+        return os.path.join(oc.optimized_model_dir, name)
+
+
+    def output_buffer(self, name, shape):
+        """Returns a view of this thread's growable buffer for output name, reshaped to shape."""
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            buffers = self.local.buffers = {}
+
+        size = int(np.prod(shape))
+        if name not in buffers or buffers[name].size < size:
+            buffers[name] = np.empty(size, dtype=self.output_types[name])
+        return buffers[name][:size].reshape(shape)
+
+
+    def run(self, inputs, output_shapes=None):
+        """Runs the session on a dict of numpy inputs and returns outputs in declaration order.
+
+        Inputs the model does not declare are ignored and the rest are cast to
+        the declared dtype. output_shapes maps output names to known shapes so
+        results are written straight into preallocated buffers.
+        """
+        feeds = {name: np.ascontiguousarray(inputs[name], dtype=self.input_types[name])
+                 for name in self.input_names if name in inputs}
+
+        if not self.use_io_binding:
+            return self.session.run(self.output_names, feeds)
+
+        binding = self.session.io_binding()
+        for name, value in feeds.items():
+            binding.bind_cpu_input(name, value)
+
+        preallocated = {}
+        for name in self.output_names:
+            if output_shapes and name in output_shapes:
+                buffer = self.output_buffer(name, output_shapes[name])
+                binding.bind_output(name, 'cpu', 0, buffer.dtype, buffer.shape, buffer.ctypes.data)
+                preallocated[name] = buffer
+            else:
+                binding.bind_output(name, 'cpu')
+
+        self.session.run_with_iobinding(binding)
+
+        if len(preallocated) == len(self.output_names):
+            return [preallocated[name] for name in self.output_names]
+
+        allocated = iter(binding.copy_outputs_to_cpu())
+        results = []
+        for name in self.output_names:
+            value = next(allocated)
+            results.append(preallocated.get(name, value))
+        return results